@@ -0,0 +1,50 @@
+"""Admin-only pages.
+
+Admins are the users named in ADMIN_USERNAMES. Everyone else gets a 404,
+so the pages don't advertise themselves.
+"""
+
+from flask import Blueprint, abort, current_app, g, jsonify
+
+from deletions import deletion_worker
+from instrumentation import prometheus_text, summary
+from passwords import hash_timings
+
+admin = Blueprint('admin', __name__, url_prefix='/admin')
+
+PASSWORD_METRICS = (
+    ('warbler_password_hash_seconds', "Password hashing time",
+     'operation', hash_timings),
+)
+
+
+@admin.before_request
+def admin_required():
+    if not g.user or g.user.username not in current_app.config['ADMIN_USERNAMES']:
+        abort(404)
+
+
+@admin.route('/deletions')
+def deletions():
+    """Progress of account deletions run by this process."""
+
+    return jsonify(deletion_worker().status())
+
+
+@admin.route('/metrics')
+def metrics():
+    """Per-endpoint request timings of this process (when
+    INSTRUMENTATION_ENABLED is set), and password hashing timings."""
+
+    return jsonify(enabled=current_app.config['INSTRUMENTATION_ENABLED'],
+                   endpoints=summary(),
+                   passwords=hash_timings.summary())
+
+
+@admin.route('/metrics/prometheus')
+def prometheus_metrics():
+    """The same, in Prometheus' text format."""
+
+    return current_app.response_class(
+        prometheus_text(PASSWORD_METRICS),
+        mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,234 @@
+"""Versioned JSON API.
+
+The data behind the HTML pages, as JSON for mobile clients:
+
+    GET           /api/v1/timeline              home timeline (login required)
+    GET           /api/v1/users/<id>            profile and counts
+    GET           /api/v1/users/<id>/messages   the user's messages
+    GET           /api/v1/users/<id>/likes      messages they liked (login required)
+    GET           /api/v1/messages/<id>         one message
+    PUT, DELETE   /api/v1/users/<id>/follow     follow/unfollow (login required)
+    PUT, DELETE   /api/v1/messages/<id>/like    like/unlike (login required)
+
+Requests are authenticated by the site's session cookie. Feeds return
+`{"messages": [...], "users": {id: author}, "next": cursor}`, listing each
+author once rather than in every message; pass `next` back as `before` for
+the following page, and `limit` to ask for smaller pages. `fields=id,text`
+trims messages (or a profile) to the named fields. Bodies are compact, and
+GETs carry an ETag so an unchanged response comes back as a bodiless 304.
+"""
+
+import json
+
+from flask import Blueprint, abort, current_app, g, request
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import HTTPException
+
+from http_cache import validate_body
+from identity import IDENTITY_FIELDS
+from models import db, User, Message, Likes
+from pagination import page_size, paginate, requested_cursor
+from social import (liked_ids, follow_user, unfollow_user, like_message,
+                    unlike_message)
+from timeline import home_timeline
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+MESSAGE_FIELDS = ('id', 'text', 'timestamp', 'user_id', 'like_count', 'liked')
+AUTHOR_FIELDS = ('id', 'username', 'image_url')
+PROFILE_FIELDS = IDENTITY_FIELDS + ('following',)
+
+api.after_request(validate_body)
+
+
+##############################################################################
+# Helpers
+
+
+def json_response(data, status=200):
+    """`data` as compact JSON."""
+
+    return current_app.response_class(
+        json.dumps(data, separators=(',', ':')),
+        status=status, mimetype='application/json')
+
+
+@api.errorhandler(HTTPException)
+def http_error(error):
+    return json_response({'error': error.description}, error.code)
+
+
+def login_required():
+    if not g.user:
+        abort(401, "Log in first.")
+
+
+def requested_fields(allowed):
+    """The `fields` asked for in the querystring (all of `allowed` if none);
+    400 if any aren't in `allowed`."""
+
+    fields = request.args.get('fields')
+    if not fields:
+        return allowed
+
+    fields = tuple(field for field in fields.split(',') if field)
+    unknown = set(fields) - set(allowed)
+    if unknown:
+        abort(400, f"Unknown fields: {', '.join(sorted(unknown))}")
+    return fields
+
+
+def requested_limit():
+    """Page size from `limit`, capped at MESSAGES_PER_PAGE."""
+
+    return max(1, min(request.args.get('limit', page_size(), type=int),
+                      page_size()))
+
+
+def pick(values, fields):
+    return {field: values[field] for field in fields}
+
+
+def message_json(message, likes, fields):
+    return pick({
+        'id': message.id,
+        'text': message.text,
+        'timestamp': message.timestamp.isoformat(),
+        'user_id': message.user_id,
+        'like_count': message.like_count,
+        'liked': message.id in likes,
+    }, fields)
+
+
+def author_json(user):
+    return {field: getattr(user, field) for field in AUTHOR_FIELDS}
+
+
+def feed_response(messages, next_cursor):
+    """A page of messages, their authors and the cursor for the next page."""
+
+    fields = requested_fields(MESSAGE_FIELDS)
+    likes = liked_ids(messages) if 'liked' in fields else set()
+
+    data = {'messages': [message_json(msg, likes, fields) for msg in messages]}
+    if 'user_id' in fields:
+        data['users'] = {str(msg.user_id): author_json(msg.user)
+                         for msg in messages}
+    if next_cursor:
+        data['next'] = next_cursor
+
+    return json_response(data)
+
+
+def user_messages(criterion, *joins):
+    """One page of messages matching `criterion`, newest first."""
+
+    query = Message.query.options(joinedload(Message.user))
+    for join in joins:
+        query = query.join(*join)
+
+    return paginate(query.filter(criterion), Message.timestamp, Message.id,
+                    requested_cursor(), requested_limit())
+
+
+##############################################################################
+# Reads
+
+
+@api.route('/timeline')
+def timeline():
+    """The logged-in user's home timeline."""
+
+    login_required()
+    messages, next_cursor = home_timeline(
+        g.user.id, requested_cursor(), requested_limit())
+    return feed_response(messages, next_cursor)
+
+
+@api.route('/users/<int:user_id>')
+def user_profile(user_id):
+    """A user's profile and counts."""
+
+    user = User.get_active_or_404(user_id)
+    profile = {field: getattr(user, field) for field in IDENTITY_FIELDS}
+    profile['following'] = bool(g.user) and g.user.is_following(user)
+
+    return json_response(pick(profile, requested_fields(PROFILE_FIELDS)))
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages_feed(user_id):
+    """A user's messages, newest first."""
+
+    User.get_active_or_404(user_id)
+    return feed_response(*user_messages(Message.user_id == user_id))
+
+
+@api.route('/users/<int:user_id>/likes')
+def user_likes_feed(user_id):
+    """Messages a user liked, newest first."""
+
+    login_required()
+    User.get_active_or_404(user_id)
+    return feed_response(*user_messages(
+        Likes.user_id == user_id, (Likes, Likes.message_id == Message.id)))
+
+
+@api.route('/messages/<int:message_id>')
+def message(message_id):
+    """A single message."""
+
+    msg = Message.query.options(joinedload(Message.user)).get_or_404(message_id)
+    return feed_response([msg], None)
+
+
+##############################################################################
+# Writes
+
+
+@api.route('/users/<int:user_id>/follow', methods=['PUT', 'DELETE'])
+def follow(user_id):
+    """Follow (PUT) or unfollow (DELETE) a user. Repeats are harmless."""
+
+    login_required()
+
+    if request.method == 'PUT':
+        changed = follow_user(g.user.id, user_id)
+    else:
+        changed = unfollow_user(g.user.id, user_id)
+
+    if not changed:
+        active = (db.session
+                  .query(User.id)
+                  .filter_by(id=user_id, deactivated=False)
+                  .scalar())
+        if not active:
+            abort(404, "No such user.")
+        if user_id == g.user.id:
+            abort(403, "Can't follow yourself.")
+
+    return json_response({'following': request.method == 'PUT'})
+
+
+@api.route('/messages/<int:message_id>/like', methods=['PUT', 'DELETE'])
+def like(message_id):
+    """Like (PUT) or unlike (DELETE) a message. Repeats are harmless."""
+
+    login_required()
+
+    if request.method == 'PUT':
+        changed = like_message(g.user.id, message_id)
+    else:
+        changed = unlike_message(g.user.id, message_id)
+
+    if not changed:
+        author_id = (db.session
+                     .query(Message.user_id)
+                     .filter_by(id=message_id)
+                     .scalar())
+        if author_id is None:
+            abort(404, "No such message.")
+        if author_id == g.user.id:
+            abort(403, "Can't like your own messages.")
+
+    return json_response({'liked': request.method == 'PUT'})
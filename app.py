@@ -1,11 +1,33 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import Flask, render_template, request, flash, redirect, session, g, abort
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
+from http_cache import install_cache_policy, not_modified, profile_state
+from static_assets import init_static_assets
+from compression import init_compression, precompress_static
 from forms import UserAddForm, LoginForm, MessageForm, EditUserForm
-from models import db, connect_db, User, Message, Likes
+from identity import init_identity_cache, load_identity, forget_identity
+from fragments import init_fragment_cache, forget_message, forget_user
+from passwords import init_password_hasher
+from api import api
+from admin import admin
+from deletions import (init_user_deletion, deletion_worker, deactivate_user,
+                       purge_user)
+from social import (liked_ids, follow_user, unfollow_user, like_message,
+                    unlike_message)
+from search import (search_users, list_all_users, install_trigram_index,
+                    search_messages, install_message_search_index,
+                    rebuild_message_index)
+from models import (db, connect_db, User, Message, Likes,
+                    reconcile_counters, create_missing_indexes)
+from pagination import paginate, requested_cursor
+from query_guard import install_query_guard
+from instrumentation import install_instrumentation
+from timeline import (fan_out_message, remove_message, rebuild_timelines,
+                      home_timeline)
 
 CURR_USER_KEY = "curr_user"
 
@@ -20,9 +42,57 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Authors with at least this many followers have their messages pulled into
+# home timelines at read time instead of being fanned out on write.
+app.config['CELEBRITY_FOLLOWER_THRESHOLD'] = int(
+    os.environ.get('CELEBRITY_FOLLOWER_THRESHOLD', 10000))
+
+# Messages per page on the home, profile and likes feeds
+app.config['MESSAGES_PER_PAGE'] = 100
+
+# Users per page on the user listing/search page, and how often (in seconds)
+# the in-process username index is rebuilt when pg_trgm isn't available
+app.config['USERS_PER_PAGE'] = 60
+app.config['USER_SEARCH_INDEX_TTL'] = 300
+
+# In message search, a message this many days newer ranks as much higher
+# as a perfect text match would
+app.config['MESSAGE_SEARCH_RECENCY_DAYS'] = 30
+
+# Users who can see the /admin pages
+app.config['ADMIN_USERNAMES'] = set(
+    filter(None, os.environ.get('ADMIN_USERNAMES', '').split(',')))
+
+# Rows removed per transaction when a deleted account is purged
+app.config['USER_DELETION_BATCH_SIZE'] = 1000
+
+# bcrypt cost factor, and how many processes hash passwords (0 = inline)
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', 2))
+
+# Seconds the logged-in user's name/avatar/counts are cached between requests
+app.config['IDENTITY_CACHE_TTL'] = int(
+    os.environ.get('IDENTITY_CACHE_TTL', 60))
+# Record per-endpoint latency, SQL and template timings (see /admin/metrics)
+app.config['INSTRUMENTATION_ENABLED'] = (
+    os.environ.get('INSTRUMENTATION_ENABLED', '') not in ('', '0'))
 # toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+# First, so the time spent in every other request hook is measured too
+install_instrumentation(app)
+install_query_guard(app)
+init_identity_cache(app)
+init_fragment_cache(app)
+init_password_hasher(app)
+init_user_deletion(app)
+app.register_blueprint(api)
+app.register_blueprint(admin)
+install_cache_policy(app)
+init_static_assets(app)
+init_compression(app)
 
 
 ##############################################################################
@@ -34,7 +104,7 @@ def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load_identity(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -100,6 +170,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # Keep a password rehashed at the current cost
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -125,38 +197,48 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username,
+    and a 'page' param for further pages of results.
     """
 
     search = request.args.get('q')
+    page = max(request.args.get('page', 1, type=int), 1)
 
     if not search:
-        users = User.query.all()
+        users, has_next = list_all_users(page)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users, has_next = search_users(search, page)
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html', users=users, search=search, page=page, has_next=has_next)
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = User.get_active_or_404(user_id)
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    if g.user:
-        likes = [like.id for like in g.user.likes]
-    else:
-        likes = []
-    return render_template('users/show.html', user=user, messages=messages, likes=likes)
+    messages, next_cursor = paginate(
+        (Message
+         .query
+         .options(joinedload(Message.user))
+         .filter(Message.user_id == user_id)),
+        Message.timestamp, Message.id, requested_cursor())
+    likes = liked_ids(messages)
+
+    unchanged = not_modified(
+        profile_state(user),
+        bool(g.user) and g.user.is_following(user),
+        [(msg.id, msg.like_count) for msg in messages],
+        sorted(likes),
+        next_cursor,
+        last_modified=messages[0].timestamp if messages else None)
+    if unchanged:
+        return unchanged
+
+    return render_template('users/show.html', user=user, messages=messages, likes=likes, next_cursor=next_cursor)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -167,7 +249,7 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = User.get_active_or_404(user_id)
     return render_template('users/following.html', user=user)
 
 
@@ -179,7 +261,7 @@ def show_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = User.get_active_or_404(user_id)
     return render_template('users/followers.html', user=user)
 
 @app.route('/users/<int:user_id>/likes')
@@ -190,89 +272,121 @@ def show_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user, messages=user.likes, likes=[like.id for like in g.user.likes])
+    user = User.get_active_or_404(user_id)
+    messages, next_cursor = paginate(
+        (Message
+         .query
+         .options(joinedload(Message.user))
+         .join(Likes, Likes.message_id == Message.id)
+         .filter(Likes.user_id == user_id)),
+        Message.timestamp, Message.id, requested_cursor())
+    return render_template('users/likes.html', user=user, messages=messages, likes=liked_ids(messages), next_cursor=next_cursor)
+
+
+def username_of(user_id):
+    """Just the username of `user_id`, for flash messages; 404 if there's
+    no such active user."""
+
+    username = (db.session
+                .query(User.username)
+                .filter(User.id == user_id, User.deactivated.is_(False))
+                .scalar())
+    if username is None:
+        abort(404)
+    return username
+
+
+def message_summary(message_id):
+    """Just the author and text of `message_id`; 404 if none."""
+
+    return (db.session
+            .query(Message.user_id, Message.text)
+            .filter(Message.id == message_id)
+            .first_or_404())
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
-    """Add a follow for the currently-logged-in user."""
-    # TODO: Add handling for if someone tries to follow a user they are already following
+    """Add a follow for the currently-logged-in user.
+
+    Following someone already followed changes nothing.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    username = username_of(follow_id)
+    if follow_id == g.user.id:
+        flash("You can't follow yourself.", "danger")
+        return redirect(f"/users/{g.user.id}")
 
-    flash(f"Now following {followed_user.username}", "success")
+    follow_user(g.user.id, follow_id)
+    flash(f"Now following {username}", "success")
 
     return redirect(f"/users/{g.user.id}/following")
 
 
 @app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
-    """Have currently-logged-in-user stop following this user."""
+    """Have currently-logged-in-user stop following this user.
+
+    Unfollowing someone not followed changes nothing.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
-
-    flash(f"No longer following {followed_user.username}", "success")
+    username = username_of(follow_id)
+    unfollow_user(g.user.id, follow_id)
+    flash(f"No longer following {username}", "success")
 
     return redirect(f"/users/{g.user.id}/following")
 
 
 @app.route('/users/add_like/<int:message_id>', methods=['POST'])
 def add_like(message_id):
-    """Add like to specified message if not made by current_user"""
+    """Add like to specified message if not made by current_user.
+
+    Liking a message already liked changes nothing.
+    """
     # TODO: Add validation to prevent bot liking
-    # TODO: Add handling for if someone tries to like a message they have already liked
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    message = Message.query.get_or_404(message_id)
+    like_message(g.user.id, message_id)
+    message = message_summary(message_id)
 
-    if g.user == message.user:
+    if message.user_id == g.user.id:
         flash("Can't like your own posts.", "danger")
         return redirect("/")
 
-    new_like = Likes(user_id=g.user.id, message_id=message_id)
-    db.session.add(new_like)
-    db.session.commit()
-
     flash(f"Liked: {message.text}", "success")
     return redirect("/")
 
 
 @app.route('/users/remove_like/<int:message_id>', methods=['POST'])
 def remove_like(message_id):
-    """Remove like from specified message if not made by current_user"""
+    """Remove like from specified message if not made by current_user.
+
+    Unliking a message not liked changes nothing.
+    """
     # TODO: Add validation to prevent bot liking
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    message = Message.query.get_or_404(message_id)
+    unlike_message(g.user.id, message_id)
+    message = message_summary(message_id)
 
-    if g.user == message.user:
+    if message.user_id == g.user.id:
         flash("Can't unlike your own posts.", "danger")
         return redirect("/")
 
-    like = Likes.query.get_or_404(
-        {"user_id": g.user.id, "message_id": message_id})
-    db.session.delete(like)
-    db.session.commit()
-
     flash(f"Unliked: {message.text}", "success")
     return redirect("/")
 
@@ -298,6 +412,8 @@ def profile():
             user.bio = form.bio.data
             user.location = form.location.data
             db.session.commit()
+            forget_identity(user.id)
+            forget_user(user.id)
             return redirect(f"/users/{user.id}")
         else:
             flash("Invalid Password.", "danger")
@@ -316,8 +432,9 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
-    db.session.commit()
+    # The account disappears now; its rows are removed in the background
+    deactivate_user(g.user.id)
+    deletion_worker().submit(g.user.id)
 
     return redirect("/signup")
 
@@ -339,9 +456,13 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        fan_out_message(msg)
         db.session.commit()
+        forget_identity(g.user.id)
+        forget_user(g.user.id)
 
         flash("Created message", "success")
         return redirect(f"/users/{g.user.id}")
@@ -349,15 +470,35 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Full-text search of messages, best matches first.
+
+    Takes the search in a 'q' param and a 'before' cursor for further pages.
+    """
+
+    search = request.args.get('q', '')
+    rows, next_cursor = search_messages(search, requested_cursor(parse=float))
+    messages = [message for message, _ in rows]
+
+    return render_template('messages/search.html', messages=messages, search=search, likes=liked_ids(messages), next_cursor=next_cursor)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    if g.user:
-        likes = [like.id for like in g.user.likes]
-    else:
-        likes = []
+    msg = Message.query.get_or_404(message_id)
+    likes = liked_ids([msg])
+
+    unchanged = not_modified(
+        profile_state(msg.user),
+        bool(g.user) and g.user.is_following(msg.user),
+        msg.id, msg.text, msg.like_count, msg.id in likes,
+        last_modified=msg.timestamp)
+    if unchanged:
+        return unchanged
+
     return render_template('messages/show.html', message=msg, user=g.user, likes=likes)
 
 
@@ -370,8 +511,16 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    # Their like counts drop with the message, so their cached counts go too
+    liker_ids = [user_id for (user_id,) in
+                 db.session.query(Likes.user_id).filter_by(message_id=msg.id)]
+
+    remove_message(msg.id)
     db.session.delete(msg)
     db.session.commit()
+    forget_identity(msg.user_id, *liker_ids)
+    forget_user(msg.user_id, *liker_ids)
+    forget_message(msg.id)
 
     flash("Deleted message.", "success")
 
@@ -387,38 +536,81 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
 
     if g.user:
-        following_ids = [user.id for user in g.user.following]
-        following_ids.append(g.user.id)
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        messages, next_cursor = home_timeline(g.user.id, requested_cursor())
 
-        return render_template('home.html', messages=messages, likes=[like.id for like in g.user.likes])
+        return render_template('home.html', messages=messages, likes=liked_ids(messages), next_cursor=next_cursor)
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# CLI commands
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines_command():
+    """Rebuild every user's materialized home timeline."""
+
+    rebuild_timelines()
+    db.session.commit()
+    print("Rebuilt home timelines.")
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recompute the denormalized follower/following/message/like counts."""
+
+    reconcile_counters()
+    db.session.commit()
+    print("Reconciled counters.")
+
+
+@app.cli.command('create-indexes')
+def create_indexes_command():
+    """Add any declared indexes missing from an existing database."""
+
+    for name in create_missing_indexes():
+        print(f"Created index {name}.")
+
+    if install_trigram_index(db.engine):
+        print("Trigram username index is in place.")
+    else:
+        print("pg_trgm unavailable; username search uses the in-process index.")
+
+    install_message_search_index(db.engine)
+    print("Message full-text index is in place.")
+
+
+@app.cli.command('compress-static')
+def compress_static_command():
+    """Write .gz (and .br) copies of compressible static files."""
+
+    for name in precompress_static(app.static_folder,
+                                   app.config['COMPRESS_MIN_SIZE']):
+        print(f"Wrote static/{name}.")
+
+
+@app.cli.command('purge-deactivated')
+def purge_deactivated_command():
+    """Finish deleting accounts left deactivated by an interrupted worker."""
+
+    user_ids = [user_id for (user_id,) in
+                db.session.query(User.id).filter(User.deactivated.is_(True))]
+
+    for user_id in user_ids:
+        progress = purge_user(user_id, app.config['USER_DELETION_BATCH_SIZE'])
+        print(f"Deleted user {user_id}: {progress}")
+
+
+@app.cli.command('rebuild-message-index')
+def rebuild_message_index_command():
+    """Re-sync the message full-text index with the messages table."""
+
+    rebuild_message_index()
+    db.session.commit()
+    print("Rebuilt message search index.")
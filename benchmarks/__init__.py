@@ -0,0 +1,9 @@
+"""Benchmarks for Warbler.
+
+Each module is a script run from the project root, e.g.
+
+    python -m benchmarks.user_search --help
+
+They create their own tables in the database named by --database, so point
+them at a scratch database, never a real one.
+"""
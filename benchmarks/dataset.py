@@ -0,0 +1,130 @@
+"""Synthetic Warbler data at a chosen scale.
+
+`seed_dataset()` fills an empty database with users, messages, follows and
+likes drawn from a seeded RNG, so the same arguments always give the same
+data. Popularity is skewed: a few users attract most follows, page views
+and likes, as on a real site. Counters, timelines and the search index are
+rebuilt afterwards, as seed.py does.
+
+Needs an app context; the caller creates the tables.
+"""
+
+from datetime import datetime, timedelta
+
+from benchmarks.user_search import SYLLABLES, fake_username
+
+# bcrypt of "password"; nobody logs in with it, sessions are forged instead
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+WORDS = [a + b for a in SYLLABLES for b in SYLLABLES]
+
+EPOCH = datetime(2020, 1, 1)
+SPAN = timedelta(days=365).total_seconds()
+
+BATCH_SIZE = 10000
+
+
+def skewed_index(rng, size, skew=2.0):
+    """An index in [0, size), low indexes (the popular ones) much likelier."""
+
+    return int(size * rng.random() ** skew)
+
+
+def insert_rows(db, table, rows):
+    """Insert an iterable of row dicts in batches."""
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            db.session.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+
+
+def unique_pairs(rng, count, pick):
+    """Up to `count` distinct pairs from `pick(rng)`, which returns a pair or
+    None to skip. Gives up after a generous number of misses, so asking for
+    more pairs than exist terminates."""
+
+    seen = set()
+    misses = 0
+    while len(seen) < count and misses < count * 10 + 1000:
+        pair = pick(rng)
+        if pair is None or pair in seen:
+            misses += 1
+            continue
+        seen.add(pair)
+        yield pair
+
+
+def seed_dataset(rng, users, messages, follows, likes):
+    """Insert the dataset; returns {'users': [ids], 'messages': [ids],
+    'words': [search terms]} for driving traffic at it."""
+
+    from models import db, User, Message, Follows, Likes, reconcile_counters
+    from search import rebuild_message_index
+    from timeline import rebuild_timelines
+
+    insert_rows(db, User.__table__, (dict(
+        username=fake_username(rng, n),
+        email=f"user{n}@example.com",
+        password=PASSWORD,
+        bio=' '.join(rng.choices(WORDS, k=6)),
+        location=rng.choice(WORDS).title(),
+    ) for n in range(users)))
+    user_ids = [user_id for (user_id,) in
+                db.session.query(User.id).order_by(User.id)]
+
+    insert_rows(db, Message.__table__, (dict(
+        text=' '.join(rng.choices(WORDS, k=rng.randint(3, 20)))[:140],
+        timestamp=EPOCH + timedelta(seconds=rng.random() * SPAN),
+        user_id=user_ids[skewed_index(rng, users, 1.5)],
+    ) for _ in range(messages)))
+    authors = dict(db.session.query(Message.id, Message.user_id))
+    message_ids = sorted(authors)
+
+    def follow(rng):
+        followed = user_ids[skewed_index(rng, users)]
+        follower = rng.choice(user_ids)
+        return (followed, follower) if followed != follower else None
+
+    insert_rows(db, Follows.__table__, (
+        dict(user_being_followed_id=followed, user_following_id=follower)
+        for followed, follower in unique_pairs(rng, follows, follow)))
+
+    def like(rng):
+        liker = rng.choice(user_ids)
+        message_id = message_ids[skewed_index(rng, len(message_ids))]
+        return (liker, message_id) if authors[message_id] != liker else None
+
+    if message_ids:
+        insert_rows(db, Likes.__table__, (
+            dict(user_id=liker, message_id=message_id)
+            for liker, message_id in unique_pairs(rng, likes, like)))
+
+    reconcile_counters()
+    rebuild_timelines()
+    rebuild_message_index()
+    db.session.commit()
+
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute('ANALYZE')
+        db.session.commit()
+
+    return {'users': user_ids, 'messages': message_ids, 'words': WORDS}
+
+
+def existing_dataset():
+    """The same description of data seeded by an earlier run."""
+
+    from models import db, User, Message
+
+    return {
+        'users': [user_id for (user_id,) in
+                  db.session.query(User.id).order_by(User.id)],
+        'messages': [message_id for (message_id,) in
+                     db.session.query(Message.id).order_by(Message.id)],
+        'words': WORDS,
+    }
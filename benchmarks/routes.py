@@ -0,0 +1,330 @@
+"""Route throughput and latency under a traffic mix.
+
+Seeds a synthetic dataset (see benchmarks.dataset), then replays a
+deterministic sequence of requests drawn from one of the MIXES, either
+through the Flask test client (in-process, no network) or against a local
+threaded WSGI server. Reports requests/second and p50/p95/p99 latency per
+route.
+
+    python -m benchmarks.routes --database postgresql:///warbler-bench
+    python -m benchmarks.routes --mix member --users 10000 --messages 200000
+    python -m benchmarks.routes --server --concurrency 8
+
+`--save-baseline` stores the results; later runs with the same settings
+compare against them and exit non-zero if any route's p95, or the overall
+throughput, is more than --tolerance worse. Baselines are per machine, so
+record one before making a change and compare after.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+from threading import Thread
+from time import perf_counter
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+##############################################################################
+# Traffic mixes
+#
+# Each is a list of (endpoint, weight, logged in?, url arguments), where the
+# url arguments are built from the RNG and the seeded dataset.
+
+
+def popular(rng, ids):
+    """One of `ids`, favouring the low (most followed, most liked) ones."""
+
+    return ids[int(len(ids) * rng.random() ** 2)]
+
+
+def some_user(rng, data):
+    return {'user_id': popular(rng, data['users'])}
+
+
+def some_message(rng, data):
+    return {'message_id': popular(rng, data['messages'])}
+
+
+def some_words(rng, data):
+    return {'q': rng.choice(data['words'])}
+
+
+def nothing(rng, data):
+    return {}
+
+
+MIXES = {
+    # Logged-out visitors reading profiles, the user list and messages
+    'browse': [
+        ('users_show', 40, False, some_user),
+        ('list_users', 20, False, some_words),
+        ('messages_show', 25, False, some_message),
+        ('messages_search', 15, False, some_words),
+    ],
+    # Logged-in users, mostly on their home timeline
+    'member': [
+        ('homepage', 50, True, nothing),
+        ('users_show', 25, True, some_user),
+        ('list_users', 10, True, some_words),
+        ('show_likes', 5, True, some_user),
+        ('messages_show', 10, True, some_message),
+    ],
+    # Mobile clients on the JSON API
+    'api': [
+        ('api.timeline', 50, True, nothing),
+        ('api.user_messages_feed', 30, True, some_user),
+        ('api.user_profile', 20, True, some_user),
+    ],
+}
+
+
+def plan_requests(app, mix, data, count, rng):
+    """[(endpoint, path, user id or None)] for `count` requests."""
+
+    from flask import url_for
+
+    routes = MIXES[mix]
+    weights = [weight for _, weight, _, _ in routes]
+
+    plan = []
+    with app.test_request_context():
+        for endpoint, _, logged_in, args in rng.choices(routes, weights, k=count):
+            user_id = rng.choice(data['users']) if logged_in else None
+            plan.append((endpoint, url_for(endpoint, **args(rng, data)), user_id))
+    return plan
+
+
+##############################################################################
+# Drivers
+#
+# A driver makes fetchers: callables taking (path, headers) and returning
+# the response's status code. Each worker thread gets its own fetcher.
+
+
+def test_client_fetcher(app):
+    client = app.test_client(use_cookies=False)
+
+    def fetch(path, headers):
+        return client.get(path, headers=headers).status_code
+
+    return fetch
+
+
+def server_fetcher(base_url):
+    def fetch(path, headers):
+        try:
+            with urlopen(Request(base_url + path, headers=headers)) as resp:
+                resp.read()
+                return resp.status
+        except HTTPError as error:
+            return error.code
+
+    return fetch
+
+
+def session_cookies(app, user_ids):
+    """{user id: Cookie header logging that user in}, forged with the app's
+    secret key so no passwords need hashing."""
+
+    from app import CURR_USER_KEY
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    return {user_id: f"{app.session_cookie_name}="
+                     f"{serializer.dumps({CURR_USER_KEY: user_id})}"
+            for user_id in set(user_ids)}
+
+
+def replay(plan, make_fetcher, cookies, concurrency, stats):
+    """Run `plan` across `concurrency` threads, recording each latency in
+    `stats` under its endpoint. Returns (wall seconds, {endpoint: errors})."""
+
+    # One tally per thread, merged once they've all finished
+    tallies = [{} for _ in range(concurrency)]
+
+    def work(share, errors):
+        fetch = make_fetcher()
+        for endpoint, path, user_id in share:
+            headers = {'Cookie': cookies[user_id]} if user_id else {}
+            start = perf_counter()
+            status = fetch(path, headers)
+            if stats is not None:
+                stats.record(endpoint, perf_counter() - start)
+            if status >= 400:
+                errors[endpoint] = errors.get(endpoint, 0) + 1
+
+    threads = [Thread(target=work, args=(plan[i::concurrency], tallies[i]))
+               for i in range(concurrency)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+
+    errors = {}
+    for tally in tallies:
+        for endpoint, count in tally.items():
+            errors[endpoint] = errors.get(endpoint, 0) + count
+    return elapsed, errors
+
+
+##############################################################################
+# Results
+
+
+def results(stats, elapsed, errors, settings):
+    summary = stats.summary()
+    return {
+        'settings': settings,
+        'throughput': sum(s['count'] for s in summary.values()) / elapsed,
+        'routes': {endpoint: {
+            'count': s['count'],
+            'errors': errors.get(endpoint, 0),
+            'p50': s['p50'] * 1000,
+            'p95': s['p95'] * 1000,
+            'p99': s['p99'] * 1000,
+        } for endpoint, s in sorted(summary.items())},
+    }
+
+
+def report(result):
+    print(f"{'route':<24} {'requests':>8} {'errors':>6} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for endpoint, route in result['routes'].items():
+        print(f"{endpoint:<24} {route['count']:>8} {route['errors']:>6} "
+              f"{route['p50']:>8.2f} {route['p95']:>8.2f} {route['p99']:>8.2f}")
+    print(f"\n{result['throughput']:.1f} requests/second")
+
+
+def regressions(result, baseline, tolerance):
+    """Descriptions of everything in `result` more than `tolerance` (a
+    fraction) worse than `baseline`."""
+
+    found = []
+    for endpoint, base in baseline['routes'].items():
+        route = result['routes'].get(endpoint)
+        if route and route['p95'] > base['p95'] * (1 + tolerance):
+            found.append(f"{endpoint}: p95 {route['p95']:.2f} ms, "
+                         f"baseline {base['p95']:.2f} ms")
+
+    if result['throughput'] < baseline['throughput'] * (1 - tolerance):
+        found.append(f"throughput {result['throughput']:.1f}/s, "
+                     f"baseline {baseline['throughput']:.1f}/s")
+    return found
+
+
+##############################################################################
+# Command line
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='sqlite:////tmp/warbler-bench.db',
+                        help="scratch database URL (tables are dropped!)")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=20000)
+    parser.add_argument('--likes', type=int, default=20000)
+    parser.add_argument('--reuse', action='store_true',
+                        help="keep the data from the previous run")
+    parser.add_argument('--mix', choices=sorted(MIXES), default='member')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=200,
+                        help="untimed requests first, to fill caches")
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--server', action='store_true',
+                        help="go through a local WSGI server, not the test client")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed slowdown against the baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    # The app reads its database URL at import time
+    os.environ['DATABASE_URL'] = args.database
+
+    from app import app
+    from metrics import LatencyStats
+    from models import db
+    from benchmarks.dataset import seed_dataset, existing_dataset
+
+    with app.app_context():
+        if args.reuse:
+            data = existing_dataset()
+        else:
+            db.drop_all()
+            db.create_all()
+            start = perf_counter()
+            data = seed_dataset(random.Random(args.seed), args.users,
+                                args.messages, args.follows, args.likes)
+            print(f"Seeded in {perf_counter() - start:.1f} s")
+        db.session.remove()
+
+    # Its own RNG, so --reuse runs replay the same plan as seeding runs
+    plan = plan_requests(app, args.mix, data, args.warmup + args.requests,
+                         random.Random(args.seed))
+    cookies = session_cookies(app, [user_id for _, _, user_id in plan if user_id])
+
+    if args.server:
+        from werkzeug.serving import make_server
+
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        make_fetcher = lambda: server_fetcher(base_url)
+    else:
+        make_fetcher = lambda: test_client_fetcher(app)
+
+    replay(plan[:args.warmup], make_fetcher, cookies, args.concurrency, None)
+    stats = LatencyStats(window=args.requests)
+    elapsed, errors = replay(plan[args.warmup:], make_fetcher, cookies,
+                             args.concurrency, stats)
+
+    if args.server:
+        server.shutdown()
+
+    settings = {
+        'dialect': args.database.split(':')[0],
+        'users': args.users, 'messages': args.messages,
+        'follows': args.follows, 'likes': args.likes,
+        'mix': args.mix, 'requests': args.requests,
+        'concurrency': args.concurrency, 'server': args.server,
+        'seed': args.seed, 'reuse': args.reuse,
+    }
+    result = results(stats, elapsed, errors, settings)
+    report(result)
+
+    if errors:
+        sys.exit(f"\n{sum(errors.values())} requests failed")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(result, baseline_file, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        return
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    # The plan doesn't depend on --reuse, so either run compares with either
+    if {**baseline['settings'], 'reuse': args.reuse} != settings:
+        sys.exit(f"\nBaseline {args.baseline} was recorded with different "
+                 f"settings: {baseline['settings']}")
+
+    found = regressions(result, baseline, args.tolerance)
+    if found:
+        sys.exit("\nRegressed against the baseline:\n  " + "\n  ".join(found))
+    print("No regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
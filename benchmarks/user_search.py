@@ -0,0 +1,131 @@
+"""Username search latency against table size.
+
+Grows the users table through each of --sizes and, at each size, times
+`search.search_users()` (trigram index on Postgres with pg_trgm, otherwise
+the in-process index) against the old unindexed `LIKE '%q%'` scan.
+
+    python -m benchmarks.user_search --database postgresql:///warbler-bench
+    python -m benchmarks.user_search --sizes 1000 10000 100000 1000000
+"""
+
+import argparse
+import os
+import random
+import string
+from statistics import median
+from time import perf_counter
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'ten', 'vo', 'zu', 'bel', 'dor', 'fin',
+             'gar', 'hul', 'jas', 'nix', 'pem', 'quo', 'sal', 'tor', 'wen']
+
+
+def fake_username(rng, n):
+    """A pronounceable, unique username."""
+
+    name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+    return f"{name}{n}"
+
+
+def grow_users(db, User, start, stop, rng):
+    """Insert users numbered [start, stop) in batches."""
+
+    table = User.__table__
+    batch = []
+    for n in range(start, stop):
+        batch.append(dict(
+            username=fake_username(rng, n),
+            email=f"user{n}@example.com",
+            password='x',
+        ))
+        if len(batch) == 10000:
+            db.session.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+    db.session.commit()
+
+
+def sample_queries(rng, count):
+    """Mostly syllable fragments (hits), plus some random strings (misses)."""
+
+    queries = [rng.choice(SYLLABLES) + rng.choice(SYLLABLES)
+               for _ in range(count - count // 4)]
+    queries += [''.join(rng.choice(string.ascii_lowercase) for _ in range(4))
+                for _ in range(count // 4)]
+    return queries
+
+
+def time_calls(fn, queries):
+    """Per-call latencies in milliseconds."""
+
+    latencies = []
+    for query in queries:
+        start = perf_counter()
+        fn(query)
+        latencies.append((perf_counter() - start) * 1000)
+    return latencies
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='sqlite:///:memory:',
+                        help="scratch database URL (tables are dropped!)")
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # The app reads its database URL at import time
+    os.environ['DATABASE_URL'] = args.database
+
+    from app import app
+    from models import db, User
+    from search import search_users, uses_trigram_index, username_index
+
+    rng = random.Random(args.seed)
+    queries = sample_queries(rng, args.queries)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        engine = 'pg_trgm' if uses_trigram_index() else 'in-process index'
+        print(f"Username search via {engine} on {db.engine.dialect.name}")
+        print(f"{'users':>10} {'search p50':>11} {'p95':>8} "
+              f"{'LIKE p50':>10} {'p95':>8} {'index build':>12}")
+
+        size = 0
+        for target in sorted(args.sizes):
+            grow_users(db, User, size, target, rng)
+            size = target
+
+            build = ''
+            if engine != 'pg_trgm':
+                app.config['USER_SEARCH_INDEX_TTL'] = 0
+                start = perf_counter()
+                username_index()
+                build = f"{(perf_counter() - start) * 1000:.0f} ms"
+                app.config['USER_SEARCH_INDEX_TTL'] = 3600
+
+            searched = time_calls(lambda q: search_users(q), queries)
+            scanned = time_calls(
+                lambda q: User.query.filter(
+                    User.username.like(f"%{q}%")).all(),
+                queries)
+
+            print(f"{size:>10} {median(searched):>8.2f} ms "
+                  f"{percentile(searched, 95):>5.2f} ms "
+                  f"{median(scanned):>7.2f} ms "
+                  f"{percentile(scanned, 95):>5.2f} ms {build:>12}")
+
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Small in-process cache used by Warbler's caching layers.
+
+MemoryCache follows the get/set/delete interface of the `cachelib` caches
+(SimpleCache, RedisCache, MemcachedCache, ...), so any of those can be
+configured in its place when the cache needs to be shared between workers.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class MemoryCache:
+    """Thread-safe, size-bounded LRU cache with per-entry expiry.
+
+    `default_timeout` is in seconds; 0 means entries never expire. Once
+    `threshold` entries are stored the least recently used one is evicted.
+    """
+
+    def __init__(self, default_timeout=300, threshold=1000):
+        self.default_timeout = default_timeout
+        self.threshold = threshold
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return the value for `key`, or None if missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires and expires <= monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        """Store `value` under `key` for `timeout` seconds."""
+
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = monotonic() + timeout if timeout else 0
+
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.threshold:
+                self._entries.popitem(last=False)
+
+        return True
+
+    def get_many(self, *keys):
+        """Return a list of values for `keys`, None where missing."""
+
+        return [self.get(key) for key in keys]
+
+    def set_many(self, mapping, timeout=None):
+        """Store every key/value pair in `mapping`."""
+
+        for key, value in mapping.items():
+            self.set(key, value, timeout)
+
+        return list(mapping)
+
+    def delete(self, key):
+        """Drop `key` if present."""
+
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def delete_many(self, *keys):
+        """Drop each of `keys` that's present."""
+
+        return [key for key in keys if self.delete(key)]
+
+    def clear(self):
+        """Drop everything."""
+
+        with self._lock:
+            self._entries.clear()
+
+        return True
@@ -0,0 +1,165 @@
+"""Response compression.
+
+Text responses at least COMPRESS_MIN_SIZE bytes long are compressed with
+brotli (if the `brotli` package is installed) or gzip, whichever the client
+prefers. Smaller bodies aren't worth the CPU or the header overhead.
+
+Static files aren't compressed per request: `flask compress-static` writes
+`.br`/`.gz` copies next to them, and the static view serves those to
+clients that accept them.
+"""
+
+import gzip
+import mimetypes
+import os
+
+from flask import current_app, request, send_from_directory, safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+    'image/x-icon',
+    'image/vnd.microsoft.icon',
+}
+
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+def available_encodings():
+    """Encodings we can produce, best first."""
+
+    return ('br', 'gzip') if brotli else ('gzip',)
+
+
+def preferred_encoding(encodings=None):
+    """The best of `encodings` the client accepts, or None."""
+
+    accepted = request.accept_encodings
+    encodings = encodings or available_encodings()
+    best = max(encodings, key=lambda encoding: accepted[encoding])
+    return best if accepted[best] else None
+
+
+def compress(data, encoding):
+    """`data` compressed with `encoding`."""
+
+    if encoding == 'br':
+        return brotli.compress(
+            data, quality=current_app.config['COMPRESS_BROTLI_QUALITY'])
+    return gzip.compress(data, compresslevel=current_app.config['COMPRESS_LEVEL'],
+                         mtime=0)
+
+
+def compress_response(response):
+    """Compress `response` in place if it's worth it and the client agrees."""
+
+    if response.mimetype not in COMPRESSIBLE_TYPES:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    if (response.direct_passthrough
+            or response.is_streamed
+            or response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or request.method == 'HEAD'):
+        return response
+
+    data = response.get_data()
+    if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    encoding = preferred_encoding()
+    if encoding is None:
+        return response
+
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+
+    # A strong ETag names these exact bytes, which have just changed
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(f"{etag}-{encoding}")
+
+    return response
+
+
+##############################################################################
+# Precompressed static files
+
+
+def _is_current(path, compressed_path):
+    """Does a compressed copy exist, and is it newer than its source?"""
+
+    try:
+        return os.path.getmtime(compressed_path) >= os.path.getmtime(path)
+    except OSError:
+        return False
+
+
+def serve_static(filename):
+    """Static view that prefers a precompressed copy of the file."""
+
+    static_folder = current_app.static_folder
+    path = safe_join(static_folder, filename)
+    variants = [encoding for encoding in available_encodings()
+                if _is_current(path, path + SUFFIXES[encoding])]
+
+    encoding = variants and preferred_encoding(variants)
+    if not encoding:
+        response = current_app.send_static_file(filename)
+    else:
+        response = send_from_directory(
+            static_folder, filename + SUFFIXES[encoding],
+            mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+            cache_timeout=current_app.get_send_file_max_age(filename))
+        response.headers['Content-Encoding'] = encoding
+
+    if variants:
+        response.vary.add('Accept-Encoding')
+
+    return response
+
+
+def precompress_static(static_folder, min_size=0):
+    """Write compressed copies of compressible static files; yields the
+    names of the files written."""
+
+    for root, _, files in os.walk(static_folder):
+        for name in files:
+            path = os.path.join(root, name)
+            # guess_type() sees through '.gz', so skip earlier runs' output
+            if (name.endswith(tuple(SUFFIXES.values()))
+                    or mimetypes.guess_type(name)[0] not in COMPRESSIBLE_TYPES
+                    or os.path.getsize(path) < min_size):
+                continue
+
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            for encoding in available_encodings():
+                target = path + SUFFIXES[encoding]
+                with open(target, 'wb') as f:
+                    f.write(compress(data, encoding))
+                yield os.path.relpath(target, static_folder)
+
+
+def init_compression(app):
+    """Compress `app`'s responses and serve precompressed static files."""
+
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', 5)
+
+    app.view_functions['static'] = serve_static
+    app.after_request(compress_response)
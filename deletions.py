@@ -0,0 +1,268 @@
+"""Background deletion of user accounts.
+
+Deleting an account in one go means the database cascading over every
+message, like and follow the user ever made, inside the request. Instead
+the account is marked deactivated at once (it can no longer log in or be
+seen), and a worker thread removes its rows in batches of
+USER_DELETION_BATCH_SIZE, committing after each one so no transaction holds
+locks for long. Counters of the users and messages on the other side are
+adjusted batch by batch.
+
+The queue lives in process memory. If the process stops mid-deletion, the
+user stays deactivated; `flask purge-deactivated` finishes the job.
+"""
+
+from datetime import datetime
+from queue import Queue
+from threading import Lock, Thread
+
+from flask import current_app
+from sqlalchemy import func, select
+
+from fragments import forget_message, forget_user
+from identity import forget_identity
+from models import db, User, Message, Likes, Follows, TimelineEntry
+from timeline import restore_authors
+
+
+##############################################################################
+# Batches
+#
+# Each removes up to `limit` rows belonging to `user_id` and returns how
+# many it removed, plus the IDs of other users and of messages whose counts
+# it changed, so their cached identity and fragments can be retired once
+# the caller has committed.
+
+
+def _ids(column, criterion, limit):
+    return [row_id for (row_id,) in
+            db.session.query(column).filter(criterion).limit(limit)]
+
+
+def _decrement(model, ids, **amounts):
+    table = model.__table__
+    db.session.execute(table.update().where(table.c.id.in_(ids)).values(
+        {table.c[column]: table.c[column] - amount
+         for column, amount in amounts.items()}))
+
+
+def delete_messages(user_id, limit):
+    """The user's messages, with their likes and timeline entries."""
+
+    ids = _ids(Message.id, Message.user_id == user_id, limit)
+    if not ids:
+        return 0, [], []
+
+    on_batch = Likes.message_id.in_(ids)
+    likers = [liker_id for (liker_id,) in
+              db.session.query(Likes.user_id).filter(on_batch).distinct()]
+
+    # Each liker loses one like per message of this batch they liked
+    User.query.filter(User.id.in_(likers)).update({
+        User.like_count: User.like_count - (
+            select([func.count()])
+            .where(on_batch & (Likes.user_id == User.id))
+            .as_scalar()),
+    }, synchronize_session=False)
+
+    Likes.query.filter(on_batch).delete(synchronize_session=False)
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.message_id.in_(ids))
+     .delete(synchronize_session=False))
+    Message.query.filter(Message.id.in_(ids)).delete(synchronize_session=False)
+
+    return len(ids), likers, ids
+
+
+def delete_likes(user_id, limit):
+    """Likes the user gave."""
+
+    ids = _ids(Likes.message_id, Likes.user_id == user_id, limit)
+    if ids:
+        _decrement(Message, ids, like_count=1)
+        (Likes
+         .query
+         .filter(Likes.user_id == user_id, Likes.message_id.in_(ids))
+         .delete(synchronize_session=False))
+    return len(ids), [], ids
+
+
+def delete_following(user_id, limit):
+    """Follows of other users by the user."""
+
+    ids = _ids(Follows.user_being_followed_id,
+               Follows.user_following_id == user_id, limit)
+    if ids:
+        _decrement(User, ids, follower_count=1)
+        (Follows
+         .query
+         .filter(Follows.user_following_id == user_id,
+                 Follows.user_being_followed_id.in_(ids))
+         .delete(synchronize_session=False))
+        restore_authors(ids)
+    return len(ids), ids, []
+
+
+def delete_followers(user_id, limit):
+    """Follows of the user by other users."""
+
+    ids = _ids(Follows.user_following_id,
+               Follows.user_being_followed_id == user_id, limit)
+    if ids:
+        _decrement(User, ids, following_count=1)
+        (Follows
+         .query
+         .filter(Follows.user_being_followed_id == user_id,
+                 Follows.user_following_id.in_(ids))
+         .delete(synchronize_session=False))
+    return len(ids), ids, []
+
+
+def delete_timeline(user_id, limit):
+    """The user's own home timeline."""
+
+    ids = _ids(TimelineEntry.message_id, TimelineEntry.user_id == user_id,
+               limit)
+    if ids:
+        (TimelineEntry
+         .query
+         .filter(TimelineEntry.user_id == user_id,
+                 TimelineEntry.message_id.in_(ids))
+         .delete(synchronize_session=False))
+    return len(ids), [], []
+
+
+# Messages go first, since they're what other users still see
+BATCHES = (
+    ('messages', delete_messages),
+    ('likes', delete_likes),
+    ('following', delete_following),
+    ('followers', delete_followers),
+    ('timeline', delete_timeline),
+)
+
+
+def purge_user(user_id, batch_size, on_batch=None):
+    """Delete a deactivated user and everything of theirs, a batch at a
+    time. Returns how many rows of each kind were removed; `on_batch`, if
+    given, is called with (kind, rows removed) after each batch."""
+
+    progress = {}
+
+    for name, delete_batch in BATCHES:
+        while True:
+            removed, users, messages = delete_batch(user_id, batch_size)
+            db.session.commit()
+            forget_identity(*users)
+            forget_user(*users)
+            forget_message(*messages)
+            if not removed:
+                break
+            progress[name] = progress.get(name, 0) + removed
+            if on_batch:
+                on_batch(name, removed)
+
+    User.query.filter_by(id=user_id).delete(synchronize_session=False)
+    db.session.commit()
+    forget_identity(user_id)
+    forget_user(user_id)
+
+    return progress
+
+
+def deactivate_user(user_id):
+    """Mark a user deactivated, so they vanish before their rows do."""
+
+    User.query.filter_by(id=user_id).update(
+        {User.deactivated: True}, synchronize_session=False)
+    db.session.commit()
+    forget_identity(user_id)
+    forget_user(user_id)
+
+
+##############################################################################
+# Worker
+
+
+class DeletionWorker:
+    """Purges queued users one at a time on a background thread, keeping
+    per-user progress for the admin page."""
+
+    def __init__(self, app):
+        self.app = app
+        self.queue = Queue()
+        self.progress = {}
+        self._lock = Lock()
+        self._thread = None
+
+    def submit(self, user_id):
+        """Queue a (deactivated) user for deletion."""
+
+        with self._lock:
+            self.progress[user_id] = {
+                'state': 'queued',
+                'queued_at': datetime.utcnow().isoformat(),
+                'deleted': {},
+            }
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run, daemon=True,
+                                      name='user-deletion')
+                self._thread.start()
+
+        self.queue.put(user_id)
+
+    def wait(self):
+        """Block until every queued deletion has finished."""
+
+        self.queue.join()
+
+    def status(self):
+        """Progress of every deletion this process has run."""
+
+        with self._lock:
+            return {user_id: dict(entry, deleted=dict(entry['deleted']))
+                    for user_id, entry in self.progress.items()}
+
+    def _update(self, user_id, **changes):
+        with self._lock:
+            self.progress[user_id].update(changes)
+
+    def _count(self, user_id, name, removed):
+        with self._lock:
+            deleted = self.progress[user_id]['deleted']
+            deleted[name] = deleted.get(name, 0) + removed
+
+    def _run(self):
+        while True:
+            user_id = self.queue.get()
+            self._update(user_id, state='running',
+                         started_at=datetime.utcnow().isoformat())
+
+            try:
+                with self.app.app_context():
+                    purge_user(user_id,
+                               self.app.config['USER_DELETION_BATCH_SIZE'],
+                               lambda name, removed:
+                               self._count(user_id, name, removed))
+                self._update(user_id, state='done')
+            except Exception as error:
+                self.app.logger.exception("Deleting user %s failed", user_id)
+                self._update(user_id, state='failed', error=repr(error))
+            finally:
+                self._update(user_id,
+                             finished_at=datetime.utcnow().isoformat())
+                self.queue.task_done()
+
+
+def init_user_deletion(app):
+    """Set up background user deletion for `app`."""
+
+    app.config.setdefault('USER_DELETION_BATCH_SIZE', 1000)
+    app.extensions['user_deletion'] = DeletionWorker(app)
+
+
+def deletion_worker():
+    """The current app's DeletionWorker."""
+
+    return current_app.extensions['user_deletion']
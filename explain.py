@@ -0,0 +1,94 @@
+"""Print the query plans behind Warbler's main views.
+
+Requests each view through the test client as the most-followed-from user,
+captures the SELECTs it runs and prints the EXPLAIN output for each, so you
+can confirm the indexes in models.py are being used.
+
+Run against a seeded Postgres database:
+
+    python explain.py               # plans as the planner would choose
+    python explain.py --no-seqscan  # discourage seq scans on small tables
+"""
+
+import argparse
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message
+
+captured = []
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def capture(conn, cursor, statement, parameters, context, executemany):
+    if statement.lstrip().upper().startswith('SELECT'):
+        captured.append((statement, parameters))
+
+
+def view_urls(user, message):
+    """(label, url) for each view worth explaining."""
+
+    return [
+        ('homepage', '/'),
+        ('list_users', '/users'),
+        ('list_users search', f'/users?q={user.username[:3]}'),
+        ('users_show', f'/users/{user.id}'),
+        ('show_following', f'/users/{user.id}/following'),
+        ('show_followers', f'/users/{user.id}/followers'),
+        ('show_likes', f'/users/{user.id}/likes'),
+        ('messages_show', f'/messages/{message.id}'),
+    ]
+
+
+def explain(statement, parameters, no_seqscan):
+    """EXPLAIN one captured statement with its original parameters."""
+
+    cursor = db.session.connection().connection.cursor()
+    if no_seqscan:
+        cursor.execute('SET enable_seqscan = off')
+    cursor.execute(f'EXPLAIN {statement}', parameters)
+    plan = [line for (line,) in cursor.fetchall()]
+    cursor.close()
+    return plan
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--no-seqscan', action='store_true',
+                        help="set enable_seqscan = off while explaining")
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    client = app.test_client()
+
+    with app.app_context():
+        user = User.query.order_by(User.following_count.desc()).first()
+        message = Message.query.filter_by(user_id=user.id).first() or Message.query.first()
+        urls = view_urls(user, message)
+
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user.id
+
+    for label, url in urls:
+        captured.clear()
+        client.get(url)
+        statements = list(captured)
+
+        print(f"=== {label}: GET {url} ({len(statements)} SELECTs)")
+
+        with app.app_context():
+            for statement, parameters in statements:
+                print()
+                print(statement.strip())
+                print()
+                for line in explain(statement, parameters, args.no_seqscan):
+                    print(f"    {line}")
+                db.session.rollback()
+
+        print()
+
+
+if __name__ == '__main__':
+    main()
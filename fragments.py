@@ -0,0 +1,136 @@
+"""Cached template fragments.
+
+Message cards and profile stats render to the same markup for everyone, so
+they're rendered once and reused from a cache. Each fragment is keyed by
+the version of what it shows: a message card by its message's and author's
+versions, the stats by the user's. `forget_message()` and `forget_user()`
+bump those versions when a route changes them (likes, deletes, profile
+edits...), so stale fragments are never looked up again and age out.
+
+Cards differ only in the like button, which depends on the viewer; there
+are four variants of each card, cached separately.
+
+Like the identity cache, the default cache lives in process memory; set
+FRAGMENT_CACHE_BACKEND to a shared cachelib-style cache to share fragments
+(and invalidations) between workers.
+"""
+
+from uuid import uuid4
+
+from flask import current_app, g
+from markupsafe import Markup
+
+from cache import MemoryCache
+
+
+def init_fragment_cache(app):
+    """Set up the fragment cache for `app` and its template helpers."""
+
+    app.config.setdefault('FRAGMENT_CACHE_TTL', 300)
+    app.config.setdefault('FRAGMENT_CACHE_SIZE', 10000)
+    app.config.setdefault('FRAGMENT_CACHE_BACKEND', None)
+
+    app.extensions['fragment_cache'] = (
+        app.config['FRAGMENT_CACHE_BACKEND']
+        or MemoryCache(default_timeout=app.config['FRAGMENT_CACHE_TTL'],
+                       threshold=app.config['FRAGMENT_CACHE_SIZE']))
+
+    app.add_template_global(message_cards)
+    app.add_template_global(profile_stats)
+
+
+def _cache():
+    return current_app.extensions['fragment_cache']
+
+
+def _version_key(kind, obj_id):
+    return f"fragment-version:{kind}:{obj_id}"
+
+
+def versions(*names):
+    """Current version tokens for (kind, id) pairs, minting missing ones.
+
+    A missing version (never set, forgotten or evicted) gets a new random
+    token, so it can't match any fragment cached before.
+    """
+
+    keys = [_version_key(kind, obj_id) for kind, obj_id in names]
+    found = _cache().get_many(*keys)
+
+    minted = {key: uuid4().hex
+              for key, version in zip(keys, found) if version is None}
+    if minted:
+        _cache().set_many(minted)
+
+    return {name: version or minted[key]
+            for name, key, version in zip(names, keys, found)}
+
+
+def forget_message(*message_ids):
+    """Retire cached cards for these messages."""
+
+    _cache().delete_many(*(_version_key('message', message_id)
+                           for message_id in message_ids))
+
+
+def forget_user(*user_ids):
+    """Retire cached stats for these users, and cards of their messages."""
+
+    _cache().delete_many(*(_version_key('user', user_id)
+                           for user_id in user_ids))
+
+
+def cached_fragments(keys, render):
+    """The fragment for each of `keys`, calling `render(i)` for the i-th
+    key's fragment when it isn't cached."""
+
+    found = _cache().get_many(*keys)
+    rendered = {}
+
+    for i, (key, html) in enumerate(zip(keys, found)):
+        if html is None:
+            found[i] = rendered[key] = render(i)
+
+    if rendered:
+        _cache().set_many(rendered)
+
+    return [Markup(html) for html in found]
+
+
+##############################################################################
+# Template helpers
+
+
+def card_variant(message, likes):
+    """Which like button the viewer sees on `message`."""
+
+    if not g.user:
+        return 'anon'
+    if message.user_id == g.user.id:
+        return 'own'
+    return 'liked' if message.id in likes else 'unliked'
+
+
+def message_cards(messages, likes):
+    """Rendered `<li>` cards for `messages`, mostly from cache."""
+
+    current = versions(*{('message', msg.id) for msg in messages},
+                       *{('user', msg.user_id) for msg in messages})
+    variants = [card_variant(msg, likes) for msg in messages]
+    keys = [f"card:{msg.id}:{current['message', msg.id]}:"
+            f"{current['user', msg.user_id]}:{variant}"
+            for msg, variant in zip(messages, variants)]
+
+    template = current_app.jinja_env.get_template('messages/card.html')
+    return cached_fragments(keys, lambda i: template.render(
+        message=messages[i], variant=variants[i]))
+
+
+def profile_stats(user):
+    """Rendered stats list for `user`'s profile header, mostly from cache."""
+
+    current = versions(('user', user.id))
+    key = f"stats:{user.id}:{current['user', user.id]}"
+
+    template = current_app.jinja_env.get_template('users/stats.html')
+    return cached_fragments([key], lambda i: template.render(user=user))[0]
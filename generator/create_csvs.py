@@ -3,14 +3,40 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Rows are written as they're generated and follows are sampled per followed
+user, so memory stays flat however many rows are asked for. Nothing is
+fetched over the network.
+
+Each table is split into --shards row ranges, generated in parallel by
+--workers processes into shard files (users.0000.csv, ...), each from its
+own seed derived from --seed. The same --seed and --shards give the same
+data however many workers run. manifest.json lists the shards in load
+order; seed.py reads it. --merge concatenates the shards back into single
+users.csv, messages.csv and follows.csv files.
+
+Message dates and authors are generated in batches with NumPy (pinned in
+requirements.txt, so a seed gives the same data on every install), and
+--message-zipf skews authorship towards a few prolific users.
+
+    python generator/create_csvs.py --merge
+    python generator/create_csvs.py --out /tmp/big --users 1000000 \\
+        --messages 10000000 --follows 50000000 --follow-alpha 1.5
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import json
+import os
+import random
+import shutil
+from datetime import datetime
+from multiprocessing import Pool
+from time import perf_counter
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import (follower_counts, sample_followers, np, random_datetimes,
+                     random_user_ids, format_datetimes)
 
 MAX_WARBLER_LENGTH = 140
 
@@ -21,10 +47,17 @@ FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
+NUM_SHARDS = 16
+
+# Message timestamps and authors are drawn this many at a time with NumPy
+BATCH_SIZE = 100000
+
+# Messages are dated in the two years up to here, unless --end says otherwise
+END_DATE = '2021-01-01'
 
-fake = Faker()
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-# Generate random profile image URLs to use for users
+# Random profile image URLs to use for users
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +65,256 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header image URLs to use for users (splashbase images 1-45)
 
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    f"https://splashbase.s3.amazonaws.com/unsplash/regular/{name}"
+    for name in [
+    "tumblr_mnh0n9pHJW1st5lhmo1_1280.jpg",
+    "tumblr_mnh0uemhCk1st5lhmo1_1280.jpg",
+    "tumblr_mnh121HEWa1st5lhmo1_1280.jpg",
+    "tumblr_mnh17lfd9R1st5lhmo1_1280.jpg",
+    "tumblr_mnh1d7s3UD1st5lhmo1_1280.jpg",
+    "tumblr_mnh1jdFvHR1st5lhmo1_1280.jpg",
+    "tumblr_mnh1uhYnog1st5lhmo1_1280.jpg",
+    "tumblr_mnh25vNOvI1st5lhmo1_1280.jpg",
+    "tumblr_mnh29fxz111st5lhmo1_1280.jpg",
+    "tumblr_mnh2m1hnS81st5lhmo1_1280.jpg",
+    "tumblr_mo1h6tGOZf1st5lhmo1_1280.jpg",
+    "tumblr_mo2wz2LTCs1st5lhmo1_1280.jpg",
+    "tumblr_mo2x3aAnRH1st5lhmo1_1280.jpg",
+    "tumblr_mo2x80NkDu1st5lhmo1_1280.jpg",
+    "tumblr_mo2x9xqeef1st5lhmo1_1280.jpg",
+    "tumblr_mo2xbk8JUK1st5lhmo1_1280.jpg",
+    "tumblr_mo2xdqmle51st5lhmo1_1280.jpg",
+    "tumblr_mo2xfarCvW1st5lhmo1_1280.jpg",
+    "tumblr_mo2xgqdEFn1st5lhmo1_1280.jpg",
+    "tumblr_mo2xijE2nr1st5lhmo1_1280.jpg",
+    "tumblr_mopq4kHmAg1st5lhmo1_1280.jpg",
+    "tumblr_mopq69jlcS1st5lhmo1_1280.jpg",
+    "tumblr_mopq8fyQwI1st5lhmo1_1280.jpg",
+    "tumblr_mopqamedKu1st5lhmo1_1280.jpg",
+    "tumblr_mopqc3ZZcz1st5lhmo1_1280.jpg",
+    "tumblr_mopqdfx05t1st5lhmo1_1280.jpg",
+    "tumblr_mopqfpSTPN1st5lhmo1_1280.jpg",
+    "tumblr_mopqhxFulr1st5lhmo1_1280.jpg",
+    "tumblr_mopqj9QUeq1st5lhmo1_1280.jpg",
+    "tumblr_mopqkkwK2M1st5lhmo1_1280.jpg",
+    "tumblr_mp6rzyNlAN1st5lhmo1_1280.jpg",
+    "tumblr_mp6s1hAudo1st5lhmo1_1280.jpg",
+    "tumblr_mp6s32zb6l1st5lhmo1_1280.jpg",
+    "tumblr_mp6s4dzqHA1st5lhmo1_1280.jpg",
+    "tumblr_mp6s661UgK1st5lhmo1_1280.jpg",
+    "tumblr_mp6s7lR1lS1st5lhmo1_1280.jpg",
+    "tumblr_mp6s995bvI1st5lhmo1_1280.jpg",
+    "tumblr_mp6sasSvPZ1st5lhmo1_1280.jpg",
+    "tumblr_mp6scv2xrZ1st5lhmo1_1280.jpg",
+    "tumblr_mpp6f50W261st5lhmo1_1280.jpg",
+    "tumblr_mpp6gwrYvm1st5lhmo1_1280.jpg",
+    "tumblr_mpp6l06zXi1st5lhmo1_1280.jpg",
+    "tumblr_mpp6poZxE51st5lhmo1_1280.jpg",
+    "tumblr_mpp6tjdFhf1st5lhmo1_1280.jpg",
+    "tumblr_mpp6w0dxAm1st5lhmo1_1280.jpg",
+    ]
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+def write_users(path, fake, rng, start, stop):
+    """Users start+1..stop. Names get their row number appended, so they stay
+    unique at any scale."""
+
+    with open(path, 'w', newline='') as users_csv:
+        users_writer = csv.writer(users_csv)
+        users_writer.writerow(USERS_CSV_HEADERS)
+
+        for n in range(start + 1, stop + 1):
+            username = f"{fake.user_name()}{n}"
+            users_writer.writerow([
+                f"{username}@{fake.free_email_domain()}",
+                username,
+                rng.choice(image_urls),
+                PASSWORD,
+                fake.sentence(),
+                rng.choice(header_image_urls),
+                fake.city(),
+            ])
+
+    return stop - start
+
+
+def write_messages(path, fake, rng, count, num_users, end, zipf=None):
+    """`count` messages, their dates and authors a batch at a time; `zipf`
+    skews authorship towards low user ids."""
+
+    with open(path, 'w', newline='') as messages_csv:
+        messages_writer = csv.writer(messages_csv)
+        messages_writer.writerow(MESSAGES_CSV_HEADERS)
+
+        generator = np.random.default_rng(rng.getrandbits(64))
+        for start in range(0, count, BATCH_SIZE):
+            size = min(BATCH_SIZE, count - start)
+            timestamps = format_datetimes(
+                random_datetimes(generator, size, end=end))
+            user_ids = random_user_ids(
+                generator, size, num_users, zipf).tolist()
+            messages_writer.writerows(zip(
+                (fake.paragraph()[:MAX_WARBLER_LENGTH] for _ in range(size)),
+                timestamps, user_ids))
+
+    return count
+
+
+def write_follows(path, rng, start, stop, count, num_users, alpha):
+    """About `count` follows of users start+1..stop, each user's followers
+    drawn without replacement so no pair repeats. Returns how many were
+    written."""
+
+    written = 0
+    with open(path, 'w', newline='') as follows_csv:
+        follows_writer = csv.writer(follows_csv)
+        follows_writer.writerow(FOLLOWS_CSV_HEADERS)
+
+        counts = (follower_counts(rng, stop - start, count, num_users, alpha)
+                  if stop > start else [])
+        for followed_user, followers in enumerate(counts, start=start + 1):
+            follows_writer.writerows(
+                (followed_user, follower) for follower in
+                sample_followers(rng, followed_user, followers, num_users))
+            written += followers
+
+    return written
+
+
+##############################################################################
+# Shards
+
+
+TABLES = ('users', 'messages', 'follows')
+
+
+def shard_ranges(count, shards):
+    """`shards` consecutive (start, stop) ranges covering range(count)."""
+
+    bounds = [count * i // shards for i in range(shards + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+
+def shard_name(table, shard):
+    return f"{table}.{shard:04d}.csv"
+
+
+def shard_jobs(args):
+    """(table, shard, options) for every shard file to write."""
+
+    users = shard_ranges(args.users, args.shards)
+    messages = shard_ranges(args.messages, args.shards)
+    follows = shard_ranges(args.follows, args.shards)
+
+    options = dict(out=args.out, seed=args.seed, end=args.end,
+                   num_users=args.users, alpha=args.follow_alpha,
+                   zipf=args.message_zipf)
+
+    return [(table, shard, dict(options, users=users[shard],
+                                messages=messages[shard],
+                                follows=follows[shard]))
+            for table in TABLES for shard in range(args.shards)]
+
+
+def write_shard(job):
+    """Write one shard file; returns (table, shard, rows written)."""
+
+    table, shard, options = job
+
+    # Every shard gets its own stream, whichever worker runs it
+    shard_seed = f"{options['seed']}:{table}:{shard}"
+    fake = Faker()
+    fake.seed_instance(shard_seed)
+    rng = random.Random(shard_seed)
+
+    path = os.path.join(options['out'], shard_name(table, shard))
+    start, stop = options['users']
+
+    if table == 'users':
+        rows = write_users(path, fake, rng, start, stop)
+    elif table == 'messages':
+        first, last = options['messages']
+        rows = write_messages(path, fake, rng, last - first,
+                              options['num_users'],
+                              datetime.fromisoformat(options['end']),
+                              options['zipf'])
+    else:
+        first, last = options['follows']
+        rows = write_follows(path, rng, start, stop, last - first,
+                             options['num_users'], options['alpha'])
+
+    return table, shard, rows
+
+
+def write_manifest(out, manifest):
+    with open(os.path.join(out, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+
+def merge_shards(out, manifest):
+    """Concatenate each table's shards into one CSV, deleting the shards."""
+
+    for table, entry in manifest['tables'].items():
+        with open(os.path.join(out, f"{table}.csv"), 'w') as merged:
+            for i, name in enumerate(entry['files']):
+                path = os.path.join(out, name)
+                with open(path) as shard:
+                    header = shard.readline()
+                    if i == 0:
+                        merged.write(header)
+                    shutil.copyfileobj(shard, merged)
+                os.remove(path)
+        entry['files'] = [f"{table}.csv"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--follow-alpha', type=float, default=None,
+                        help="power-law shape for follower counts, e.g. 1.5 "
+                             "(smaller is more skewed); uniform if not given")
+    parser.add_argument('--message-zipf', type=float, default=None,
+                        help="Zipf exponent skewing who posts, e.g. 1.1; "
+                             "uniform if not given")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--end', default=END_DATE,
+                        help="latest message date (YYYY-MM-DD)")
+    parser.add_argument('--shards', type=int, default=NUM_SHARDS,
+                        help="files per table; part of what --seed reproduces")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="processes generating shards")
+    parser.add_argument('--merge', action='store_true',
+                        help="combine each table's shards into one CSV")
+    parser.add_argument('--out', default='generator',
+                        help="directory to write the CSVs to")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    with Pool(args.workers) as pool:
+        written = pool.map(write_shard, shard_jobs(args), chunksize=1)
+
+    manifest = {
+        'seed': args.seed,
+        'shards': args.shards,
+        'tables': {table: {
+            'files': [shard_name(table, shard) for shard in range(args.shards)],
+            'rows': sum(rows for name, _, rows in written if name == table),
+        } for table in TABLES},
+    }
+    if args.merge:
+        merge_shards(args.out, manifest)
+    write_manifest(args.out, manifest)
+
+    rows = {table: entry['rows'] for table, entry in manifest['tables'].items()}
+    print(f"Wrote {rows['users']} users, {rows['messages']} messages and "
+          f"{rows['follows']} follows in {perf_counter() - start:.1f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,93 @@
-"""Support functions for CSV generation."""
+"""Support functions for CSV generation.
 
-from datetime import datetime
-from random import uniform
+The batch functions at the bottom use NumPy to produce a whole column of
+values per call instead of one Python object per row.
+"""
 
+from array import array
+from datetime import datetime, timedelta
+from functools import lru_cache
+from math import floor
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+import numpy as np
 
-    now = datetime.now()
+
+def follower_counts(rng, followed, num_follows, num_users, alpha=None):
+    """How many followers each of `followed` users gets, as an array.
+
+    With `alpha`, counts follow a power law (Pareto with that shape; smaller
+    is more skewed), so a few users have most of the followers. Without it,
+    every user is equally likely to be followed. Either way the counts add
+    up to roughly `num_follows`, and nobody gets more than num_users - 1
+    (everyone else).
+    """
+
+    if alpha:
+        weights = array('d', (rng.paretovariate(alpha)
+                              for _ in range(followed)))
+    else:
+        weights = array('d', (rng.random() for _ in range(followed)))
+
+    scale = num_follows / sum(weights)
+    cap = num_users - 1
+
+    # Round up or down at random, so the total stays close on average
+    return array('l', (min(cap, floor(weight * scale + rng.random()))
+                       for weight in weights))
+
+
+def sample_followers(rng, user_id, count, num_users):
+    """`count` distinct followers for `user_id`, excluding the user itself.
+
+    Samples from a range, so only the chosen ids are ever held in memory.
+    """
+
+    return [follower + 1 if follower >= user_id else follower
+            for follower in rng.sample(range(1, num_users), count)]
+
+
+##############################################################################
+# Batches (NumPy)
+
+
+def random_datetimes(generator, count, year_gap=2, end=None):
+    """`count` random datetimes in the few years before `end` (default now),
+    as a datetime64[us] array. `generator` is a numpy.random.Generator."""
+
+    now = end or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    span = (now - then) // timedelta(microseconds=1)
+
+    offsets = generator.integers(0, span, size=count)
+    return np.datetime64(then, 'us') + offsets.astype('timedelta64[us]')
+
+
+@lru_cache(maxsize=8)
+def _zipf_cdf(num_users, exponent):
+    weights = np.arange(1, num_users + 1, dtype=np.float64) ** -exponent
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def random_user_ids(generator, count, num_users, zipf=None):
+    """`count` user ids in 1..num_users, as an int64 array.
+
+    With `zipf` (an exponent, e.g. 1.1), user k is picked in proportion to
+    1 / k ** zipf, so low ids get most of the rows; otherwise every user is
+    equally likely.
+    """
+
+    if not zipf:
+        return generator.integers(1, num_users + 1, size=count)
+
+    cdf = _zipf_cdf(num_users, zipf)
+    ranks = np.searchsorted(cdf, generator.random(count), side='right')
+    return np.minimum(ranks, num_users - 1) + 1
+
+
+def format_datetimes(stamps):
+    """A datetime64 array as the strings the CSVs use
+    ('2020-06-01 12:34:56.789012'), in one pass."""
 
-    return datetime.fromtimestamp(random_timestamp)
+    return np.char.replace(
+        np.datetime_as_string(stamps, unit='us'), 'T', ' ').tolist()
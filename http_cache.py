@@ -0,0 +1,124 @@
+"""HTTP caching policy.
+
+Every response gets its Cache-Control header here:
+
+- static files requested with their current `v` fingerprint are cached for
+  a year as immutable, since a changed file gets a new URL; other static
+  files (or a stale or made-up `v`) must be revalidated, which Flask
+  answers with a 304 from their ETag;
+- pages whose views call `not_modified()`, and responses passed through
+  `validate_body()`, carry an ETag (and maybe Last-Modified) and get a 304
+  when the client's copy is still current. They're `public` for anonymous
+  visitors and `private` for logged-in ones, whose nav bar and buttons
+  depend on who's looking;
+- other pages tied to a session (logged in, flashed messages, CSRF-protected
+  forms) are `private, no-store`; anything else must be revalidated.
+"""
+
+from hashlib import sha1
+
+from flask import current_app, g, request, session
+
+from identity import IDENTITY_FIELDS
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def profile_state(user):
+    """The parts of `user` a page shows, for building an ETag."""
+
+    return tuple(getattr(user, field) for field in IDENTITY_FIELDS)
+
+
+def not_modified(*parts, last_modified=None):
+    """Check the client's copy of the page about to be rendered.
+
+    `parts` must cover everything the page shows; who is viewing it is
+    added here. Returns a 304 response if the client's ETag still matches,
+    otherwise None, and the validators go out with the rendered page.
+    Last-Modified is informational: only the ETag is used to answer 304s.
+    """
+
+    if '_flashes' in session:
+        # Rendering the page is what pops the flashed messages
+        return None
+
+    viewer = profile_state(g.user) if g.user else None
+    etag = sha1(repr((viewer, parts)).encode()).hexdigest()
+    g.cache_validators = (etag, last_modified)
+
+    if request.if_none_match.contains_weak(etag):
+        return current_app.response_class(status=304)
+
+    return None
+
+
+def validate_body(response):
+    """Give a GET response an ETag hashed from its body, and turn it into a
+    304 if the client has that body already.
+
+    For responses that are cheaper to build than to send, like the JSON API.
+    Must run before apply_cache_policy().
+    """
+
+    if (request.method != 'GET' or response.status_code != 200
+            or response.direct_passthrough or '_flashes' in session):
+        return response
+
+    etag = sha1(response.get_data()).hexdigest()
+    g.cache_validators = (etag, None)
+
+    if request.if_none_match.contains_weak(etag):
+        return current_app.response_class(status=304)
+
+    return response
+
+
+def apply_cache_policy(response):
+    """Set Cache-Control (and validators) on `response`."""
+
+    cache_control = response.cache_control
+
+    if request.endpoint == 'static':
+        filename = (request.view_args or {}).get('filename')
+        version = current_app.extensions['static_manifest'].get(filename)
+        if version is not None and request.args.get('v') == version:
+            cache_control.public = True
+            cache_control.max_age = STATIC_MAX_AGE
+            cache_control.immutable = True
+        else:
+            cache_control.public = True
+            cache_control.max_age = None
+            cache_control.no_cache = True
+            response.expires = None
+        return response
+
+    validators = g.pop('cache_validators', None)
+
+    if validators and response.status_code in (200, 304):
+        etag, last_modified = validators
+        response.set_etag(etag, weak=True)
+        if last_modified:
+            response.last_modified = last_modified
+
+        if g.user:
+            cache_control.private = True
+        else:
+            cache_control.public = True
+        cache_control.no_cache = True
+        response.vary.add('Cookie')
+
+    elif session or g.get('user'):
+        cache_control.private = True
+        cache_control.no_store = True
+
+    else:
+        cache_control.no_cache = True
+
+    return response
+
+
+def install_cache_policy(app):
+    """Apply the caching policy to every response from `app`."""
+
+    app.after_request(apply_cache_policy)
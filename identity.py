@@ -0,0 +1,121 @@
+"""Cached identity for the logged-in user.
+
+Every request needs the current user's name, avatar and counts to render
+the nav bar and sidebar, but few requests change them. Rather than loading
+the User row each time, those fields are cached by user ID for
+IDENTITY_CACHE_TTL seconds and exposed through CurrentUser. The full ORM
+User is only loaded if a view touches something that isn't cached.
+
+The default cache lives in process memory, so other workers may show stale
+fields for up to the TTL after a change. Set IDENTITY_CACHE_BACKEND to a
+shared cachelib-style cache (e.g. RedisCache) to avoid that.
+"""
+
+from flask import current_app
+
+from cache import MemoryCache
+from models import User
+
+IDENTITY_FIELDS = (
+    'id',
+    'username',
+    'image_url',
+    'header_image_url',
+    'bio',
+    'location',
+    'message_count',
+    'following_count',
+    'follower_count',
+    'like_count',
+)
+
+
+class CurrentUser:
+    """The logged-in user, answered from cached fields where possible.
+
+    Anything else (relationships, email, password...) loads the real User
+    on first use; `model` returns it directly, e.g. to delete it.
+    """
+
+    # These only rely on `id`, so they work without loading the User.
+    following_ids = User.following_ids
+    follower_ids = User.follower_ids
+    is_following = User.is_following
+    is_followed_by = User.is_followed_by
+    liked_message_ids = User.liked_message_ids
+
+    _following_ids = None
+    _follower_ids = None
+    _model = None
+
+    def __init__(self, fields, model=None):
+        self._fields = fields
+        self._model = model
+
+    @property
+    def model(self):
+        """The full ORM User, loaded on demand."""
+
+        if self._model is None:
+            self._model = User.query.get(self._fields['id'])
+        return self._model
+
+    def __getattr__(self, name):
+        if self._model is None and name in self._fields:
+            return self._fields[name]
+        return getattr(self.model, name)
+
+    def __eq__(self, other):
+        if isinstance(other, (User, CurrentUser)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+
+def init_identity_cache(app):
+    """Set up the identity cache for `app` from its config."""
+
+    app.config.setdefault('IDENTITY_CACHE_TTL', 60)
+    app.config.setdefault('IDENTITY_CACHE_BACKEND', None)
+
+    app.extensions['identity_cache'] = (
+        app.config['IDENTITY_CACHE_BACKEND']
+        or MemoryCache(default_timeout=app.config['IDENTITY_CACHE_TTL'],
+                       threshold=10000))
+
+
+def _cache_key(user_id):
+    return f"identity:{user_id}"
+
+
+def load_identity(user_id):
+    """CurrentUser for `user_id`, from cache if possible; None if no such
+    (active) user."""
+
+    cache = current_app.extensions['identity_cache']
+    fields = cache.get(_cache_key(user_id))
+
+    if fields is not None:
+        return CurrentUser(fields)
+
+    user = User.query.get(user_id)
+    if user is None or user.deactivated:
+        return None
+
+    fields = {field: getattr(user, field) for field in IDENTITY_FIELDS}
+    cache.set(_cache_key(user_id), fields,
+              timeout=current_app.config['IDENTITY_CACHE_TTL'])
+    return CurrentUser(fields, model=user)
+
+
+def forget_identity(*user_ids):
+    """Drop cached identities after their profile or counts change."""
+
+    cache = current_app.extensions['identity_cache']
+    for user_id in user_ids:
+        cache.delete(_cache_key(user_id))
@@ -0,0 +1,166 @@
+"""Per-request timing.
+
+With INSTRUMENTATION_ENABLED set, every request records, under its
+endpoint: total latency, SQL statement count (from query_guard's counter),
+time spent in SQL, and time spent rendering templates. The figures also go
+back to the browser in a Server-Timing header. Aggregates are served to
+admins by admin.py, as JSON or in Prometheus text format.
+
+When disabled (the default) none of the hooks are installed, so requests
+pay nothing for it.
+"""
+
+from time import perf_counter
+
+from flask import before_render_template, g, has_request_context, request
+from flask import template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import LatencyStats
+
+MEASURES = ('latency', 'sql_count', 'sql_time', 'template_time')
+
+request_stats = {measure: LatencyStats() for measure in MEASURES}
+
+
+def _timings():
+    return g.get('request_timings') if has_request_context() else None
+
+
+# The start time rides on the statement's execution context, which is
+# dropped with it, so a statement that raises leaves nothing behind
+
+
+def _start_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    context._instrumentation_start = perf_counter()
+
+
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    timings = _timings()
+    if timings is not None:
+        timings['sql_time'] += perf_counter() - context._instrumentation_start
+
+
+def _start_template(app, template, context, **extra):
+    timings = _timings()
+    if timings is not None:
+        timings['template_starts'].append(perf_counter())
+
+
+def _end_template(app, template, context, **extra):
+    timings = _timings()
+    if timings is not None and timings['template_starts']:
+        started = timings['template_starts'].pop()
+        # Only count the outermost render; nested ones are inside it
+        if not timings['template_starts']:
+            timings['template_time'] += perf_counter() - started
+
+
+_engine_hooks_installed = False
+
+
+def install_instrumentation(app):
+    """Time `app`'s requests if INSTRUMENTATION_ENABLED is set.
+
+    Call this before installing other after_request hooks, so that the time
+    they take is counted too.
+    """
+
+    global _engine_hooks_installed
+
+    app.config.setdefault('INSTRUMENTATION_ENABLED', False)
+    if not app.config['INSTRUMENTATION_ENABLED']:
+        return
+
+    if not _engine_hooks_installed:
+        event.listen(Engine, 'before_cursor_execute', _start_statement)
+        event.listen(Engine, 'after_cursor_execute', _end_statement)
+        _engine_hooks_installed = True
+
+    before_render_template.connect(_start_template, app)
+    template_rendered.connect(_end_template, app)
+
+    @app.before_request
+    def start_timing():
+        g.request_timings = {
+            'start': perf_counter(),
+            'sql_time': 0.0,
+            'template_time': 0.0,
+            'template_starts': [],
+        }
+
+    @app.after_request
+    def record_timing(response):
+        timings = g.pop('request_timings', None)
+        if timings is None:
+            return response
+
+        latency = perf_counter() - timings['start']
+        endpoint = request.endpoint or 'unmatched'
+        measured = {
+            'latency': latency,
+            'sql_count': g.get('sql_statement_count', 0),
+            'sql_time': timings['sql_time'],
+            'template_time': timings['template_time'],
+        }
+        for measure, value in measured.items():
+            request_stats[measure].record(endpoint, value)
+
+        response.headers['Server-Timing'] = (
+            f'sql;dur={timings["sql_time"] * 1000:.1f};'
+            f'desc="{measured["sql_count"]} statements", '
+            f'tpl;dur={timings["template_time"] * 1000:.1f}, '
+            f'total;dur={latency * 1000:.1f}')
+        return response
+
+
+def summary():
+    """{endpoint: {measure: {count, total, mean, max, p50, p95, p99}}}."""
+
+    by_endpoint = {}
+    for measure, stats in request_stats.items():
+        for endpoint, figures in stats.summary().items():
+            by_endpoint.setdefault(endpoint, {})[measure] = figures
+    return by_endpoint
+
+
+##############################################################################
+# Prometheus text format
+
+
+PROMETHEUS_METRICS = (
+    ('latency', 'warbler_request_seconds', "Request latency"),
+    ('sql_count', 'warbler_request_sql_statements', "SQL statements per request"),
+    ('sql_time', 'warbler_request_sql_seconds', "Time in SQL per request"),
+    ('template_time', 'warbler_request_template_seconds',
+     "Template rendering time per request"),
+)
+
+
+QUANTILES = (('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99'))
+
+
+def _summary_lines(name, help_text, label, stats):
+    yield f"# HELP {name} {help_text}"
+    yield f"# TYPE {name} summary"
+    for key, figures in sorted(stats.summary().items()):
+        for quantile, field in QUANTILES:
+            yield (f'{name}{{{label}="{key}",quantile="{quantile}"}} '
+                   f'{figures[field]}')
+        yield f'{name}_sum{{{label}="{key}"}} {figures["total"]}'
+        yield f'{name}_count{{{label}="{key}"}} {figures["count"]}'
+
+
+def prometheus_text(extra=()):
+    """All request metrics, plus any (name, help, label, LatencyStats) in
+    `extra`, in Prometheus' text exposition format."""
+
+    lines = []
+    for measure, name, help_text in PROMETHEUS_METRICS:
+        lines.extend(_summary_lines(name, help_text, 'endpoint',
+                                    request_stats[measure]))
+    for name, help_text, label, stats in extra:
+        lines.extend(_summary_lines(name, help_text, label, stats))
+    return '\n'.join(lines) + '\n'
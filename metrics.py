@@ -0,0 +1,66 @@
+"""In-process latency statistics.
+
+Keeps a count, running total and maximum per key, plus a bounded window of
+recent samples from which percentiles are computed on demand.
+"""
+
+from collections import defaultdict, deque
+from threading import Lock
+
+
+def percentile(ordered, fraction):
+    """The `fraction` (0-1) percentile of an already sorted list."""
+
+    if not ordered:
+        return None
+    index = min(int(fraction * len(ordered)), len(ordered) - 1)
+    return ordered[index]
+
+
+class LatencyStats:
+    """Timings (in seconds) grouped by key."""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._lock = Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=self.window))
+        self._totals = defaultdict(lambda: [0, 0.0, 0.0])
+
+    def record(self, key, seconds):
+        """Add one timing for `key`."""
+
+        with self._lock:
+            self._samples[key].append(seconds)
+            totals = self._totals[key]
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+
+    def summary(self):
+        """{key: {count, total, mean, max, p50, p95, p99}}, percentiles taken over
+        the most recent `window` samples."""
+
+        with self._lock:
+            snapshot = {key: (list(self._samples[key]), list(totals))
+                        for key, totals in self._totals.items()}
+
+        summary = {}
+        for key, (samples, (count, total, maximum)) in snapshot.items():
+            samples.sort()
+            summary[key] = {
+                'count': count,
+                'total': total,
+                'mean': total / count,
+                'max': maximum,
+                'p50': percentile(samples, 0.50),
+                'p95': percentile(samples, 0.95),
+                'p99': percentile(samples, 0.99),
+            }
+        return summary
+
+    def clear(self):
+        """Forget everything recorded so far."""
+
+        with self._lock:
+            self._samples.clear()
+            self._totals.clear()
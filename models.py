@@ -2,10 +2,12 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, false, func, inspect, literal, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from passwords import password_hasher
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
@@ -14,6 +16,12 @@ class Follows(db.Model):
 
     __tablename__ = 'follows'
 
+    # The primary key covers "who follows X"; this covers "who does X follow".
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id_user_being_followed_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -32,6 +40,11 @@ class Likes(db.Model):
 
     __tablename__ = 'likes'
 
+    # The primary key covers a user's likes; this covers a message's likers.
+    __table_args__ = (
+        db.Index('ix_likes_message_id_user_id', 'message_id', 'user_id'),
+    )
+
     user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete='cascade'),
@@ -90,43 +103,138 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Set when the user deletes their account; the rows are then removed in
+    # the background (see deletions.py).
+
+    deactivated = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=false(),
+    )
+
+    # Denormalized counters, kept in step by the listeners at the bottom
+    # of this module. `flask reconcile-counters` repairs any drift.
+
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # passive_deletes leaves removing a deleted user's rows to the
+    # database's ON DELETE CASCADE instead of loading them all first.
+
+    messages = db.relationship('Message', passive_deletes=True)
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        passive_deletes=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        passive_deletes=True,
     )
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        passive_deletes=True,
     )
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    # ID sets backing is_following/is_followed_by. Each is loaded with one
+    # narrow query the first time it's needed and forgotten whenever the
+    # instance is expired (e.g. on commit), so a page listing many users
+    # does one lookup instead of scanning a collection per user.
+    _following_ids = None
+    _follower_ids = None
+
+    @property
+    def following_ids(self):
+        """Set of IDs of the users this user follows."""
+
+        if self._following_ids is None:
+            rows = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == self.id))
+            self._following_ids = {followed_id for (followed_id,) in rows}
+        return self._following_ids
+
+    @property
+    def follower_ids(self):
+        """Set of IDs of the users following this user."""
+
+        if self._follower_ids is None:
+            rows = (db.session
+                    .query(Follows.user_following_id)
+                    .filter(Follows.user_being_followed_id == self.id))
+            self._follower_ids = {follower_id for (follower_id,) in rows}
+        return self._follower_ids
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.follower_ids
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_ids
+
+    def liked_message_ids(self, message_ids):
+        """Which of `message_ids` has this user liked? Returns a set.
+
+        Only the likes among the given messages are read, so the cost
+        depends on the page being shown, not on how much the user likes.
+        """
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
+
+        rows = (db.session
+                .query(Likes.message_id)
+                .filter(Likes.user_id == self.id,
+                        Likes.message_id.in_(message_ids)))
+        return {message_id for (message_id,) in rows}
+
+    @classmethod
+    def get_active_or_404(cls, user_id):
+        """The user with this ID, or 404 if missing or deactivated."""
+
+        return cls.query.filter_by(id=user_id, deactivated=False).first_or_404()
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -135,7 +243,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_hasher().hash(password)
 
         user = User(
             username=username,
@@ -156,13 +264,19 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A hash made at a different cost than BCRYPT_LOG_ROUNDS is replaced;
+        the caller commits the change.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deactivated=False).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            hasher = password_hasher()
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
@@ -186,7 +300,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -195,9 +309,300 @@ class Message(db.Model):
         nullable=False,
     )
 
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
-    liked_by = db.relationship('User', secondary="likes")
+    liked_by = db.relationship('User', secondary="likes", passive_deletes=True)
+
+
+# Profile feeds filter on user_id and page newest first by (timestamp, id).
+db.Index('ix_messages_user_id_timestamp_id',
+         Message.user_id, Message.timestamp.desc(), Message.id)
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline.
+
+    Rows are written when a message is posted (fan-out on write), so the
+    home page is a single primary key range scan instead of a join over
+    everyone the user follows.
+    """
+
+    __tablename__ = 'timelines'
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_author_id', 'user_id', 'author_id'),
+        db.Index('ix_timelines_message_id', 'message_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+
+##############################################################################
+# Counter maintenance
+#
+# These run inside the flush that writes the row, so counters commit (or roll
+# back) together with the change. Writes must go through the Follows, Likes
+# and Message models (not the `following`/`likes` collections), or the follow
+# and like helpers below, to be counted.
+#
+# Deleting a message or user removes its likes/follows by database cascade, so
+# those counters are adjusted up front in `before_flush`, while the rows the
+# adjustments are computed from still exist.
+
+
+def _adjust(bind, model, criterion, **deltas):
+    """Add each of `deltas` to the matching counter columns of `model`."""
+
+    table = model.__table__
+    bind.execute(table.update().where(criterion).values(
+        {table.c[column]: table.c[column] + delta
+         for column, delta in deltas.items()}))
+
+
+@event.listens_for(Message, 'after_insert')
+def _count_new_message(mapper, connection, message):
+    _adjust(connection, User, User.id == message.user_id, message_count=1)
+
+
+@event.listens_for(Likes, 'after_insert')
+def _count_new_like(mapper, connection, like):
+    _adjust(connection, User, User.id == like.user_id, like_count=1)
+    _adjust(connection, Message, Message.id == like.message_id, like_count=1)
+
+
+@event.listens_for(Likes, 'after_delete')
+def _uncount_like(mapper, connection, like):
+    _adjust(connection, User, User.id == like.user_id, like_count=-1)
+    _adjust(connection, Message, Message.id == like.message_id, like_count=-1)
+
+
+@event.listens_for(Follows, 'after_insert')
+def _count_new_follow(mapper, connection, follow):
+    _adjust(connection, User, User.id == follow.user_following_id,
+            following_count=1)
+    _adjust(connection, User, User.id == follow.user_being_followed_id,
+            follower_count=1)
+
+
+@event.listens_for(Follows, 'after_delete')
+def _uncount_follow(mapper, connection, follow):
+    _adjust(connection, User, User.id == follow.user_following_id,
+            following_count=-1)
+    _adjust(connection, User, User.id == follow.user_being_followed_id,
+            follower_count=-1)
+
+
+def _uncount_message(session, message):
+    _adjust(session, User, User.id == message.user_id, message_count=-1)
+    _adjust(session, User,
+            User.id.in_(select([Likes.user_id])
+                        .where(Likes.message_id == message.id)),
+            like_count=-1)
+
+
+def _uncount_user(session, user):
+    _adjust(session, User,
+            User.id.in_(select([Follows.user_being_followed_id])
+                        .where(Follows.user_following_id == user.id)),
+            follower_count=-1)
+    _adjust(session, User,
+            User.id.in_(select([Follows.user_following_id])
+                        .where(Follows.user_being_followed_id == user.id)),
+            following_count=-1)
+    _adjust(session, Message,
+            Message.id.in_(select([Likes.message_id])
+                           .where(Likes.user_id == user.id)),
+            like_count=-1)
+
+    # People who liked this user's messages lose one like per message.
+    likes_received = (select([func.count()])
+                      .where(Likes.user_id == User.id)
+                      .where(Likes.message_id == Message.id)
+                      .where(Message.user_id == user.id)
+                      .as_scalar())
+    _adjust(session, User,
+            User.id.in_(select([Likes.user_id])
+                        .where(Likes.message_id == Message.id)
+                        .where(Message.user_id == user.id)),
+            like_count=-likes_received)
+
+
+@event.listens_for(db.session, 'before_flush')
+def _uncount_deleted(session, flush_context, instances):
+    for obj in session.deleted:
+        if isinstance(obj, Message):
+            _uncount_message(session, obj)
+        elif isinstance(obj, User):
+            _uncount_user(session, obj)
+
+
+@event.listens_for(User, 'expire')
+def _forget_follow_ids(user, attrs):
+    user._following_ids = None
+    user._follower_ids = None
+
+
+##############################################################################
+# Follow and like writes
+#
+# One idempotent INSERT or DELETE each, without loading either side's rows
+# or collections. They bypass the mapper events above, so they adjust the
+# counters themselves, and only when a row was actually written.
+
+
+def _insert_if_new(table):
+    """INSERT into `table` that skips rows violating its primary key."""
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return pg_insert(table).on_conflict_do_nothing()
+    return table.insert().prefix_with('OR IGNORE')
+
+
+def follow(user_id, followed_id):
+    """Make `user_id` follow `followed_id`. Caller commits.
+
+    Returns True if a follow was added; False if it already existed,
+    there's no such (active) user to follow, or it's the user themselves.
+    """
+
+    follows = Follows.__table__
+    added = db.session.execute(_insert_if_new(follows).from_select(
+        [follows.c.user_being_followed_id, follows.c.user_following_id],
+        select([User.id, literal(user_id)])
+        .where((User.id == followed_id) & User.deactivated.is_(False)
+               & (User.id != user_id)),
+    )).rowcount
+
+    if added:
+        _adjust(db.session, User, User.id == user_id, following_count=1)
+        _adjust(db.session, User, User.id == followed_id, follower_count=1)
+    return bool(added)
+
+
+def unfollow(user_id, followed_id):
+    """Make `user_id` stop following `followed_id`. Caller commits.
+
+    Returns True if a follow was removed.
+    """
+
+    removed = db.session.execute(Follows.__table__.delete().where(
+        (Follows.user_following_id == user_id)
+        & (Follows.user_being_followed_id == followed_id))).rowcount
+
+    if removed:
+        _adjust(db.session, User, User.id == user_id, following_count=-1)
+        _adjust(db.session, User, User.id == followed_id, follower_count=-1)
+    return bool(removed)
+
+
+def like(user_id, message_id):
+    """Have `user_id` like `message_id`. Caller commits.
+
+    Returns True if a like was added; False if it already existed, there's
+    no such message, or it's the user's own message.
+    """
+
+    likes = Likes.__table__
+    added = db.session.execute(_insert_if_new(likes).from_select(
+        [likes.c.user_id, likes.c.message_id],
+        select([literal(user_id), Message.id])
+        .where((Message.id == message_id) & (Message.user_id != user_id)),
+    )).rowcount
+
+    if added:
+        _adjust(db.session, User, User.id == user_id, like_count=1)
+        _adjust(db.session, Message, Message.id == message_id, like_count=1)
+    return bool(added)
+
+
+def unlike(user_id, message_id):
+    """Remove `user_id`'s like of `message_id`. Caller commits.
+
+    Returns True if a like was removed.
+    """
+
+    removed = db.session.execute(Likes.__table__.delete().where(
+        (Likes.user_id == user_id)
+        & (Likes.message_id == message_id))).rowcount
+
+    if removed:
+        _adjust(db.session, User, User.id == user_id, like_count=-1)
+        _adjust(db.session, Message, Message.id == message_id, like_count=-1)
+    return bool(removed)
+
+
+def reconcile_counters():
+    """Recompute every denormalized counter from the underlying tables.
+
+    Used after bulk loads (which skip the listeners) or to repair drift.
+    Caller commits.
+    """
+
+    def count(column, criterion):
+        return select([func.count(column)]).where(criterion).as_scalar()
+
+    User.query.update({
+        User.message_count: count(Message.id, Message.user_id == User.id),
+        User.following_count: count(Follows.user_being_followed_id,
+                                    Follows.user_following_id == User.id),
+        User.follower_count: count(Follows.user_following_id,
+                                   Follows.user_being_followed_id == User.id),
+        User.like_count: count(Likes.message_id, Likes.user_id == User.id),
+    }, synchronize_session=False)
+
+    Message.query.update({
+        Message.like_count: count(Likes.user_id,
+                                  Likes.message_id == Message.id),
+    }, synchronize_session=False)
+
+
+def create_missing_indexes():
+    """Create any index declared above that an existing database lacks.
+
+    `db.create_all()` only builds indexes along with new tables, so this
+    brings older databases up to date. Returns the names it created.
+    """
+
+    inspector = inspect(db.engine)
+    created = []
+
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine)
+                created.append(index.name)
+
+    return created
 
 
 def connect_db(app):
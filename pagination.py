@@ -0,0 +1,94 @@
+"""Keyset (cursor) pagination for message feeds.
+
+Feeds are ordered newest first by (timestamp, id). Rather than an OFFSET,
+each page ends with an opaque `before` cursor naming its last message, and
+the next page starts strictly after it. Fetching page 1000 costs the same
+index range scan as fetching page 1.
+
+Other orderings (e.g. search relevance) can reuse the same cursors with a
+different sort value in place of the timestamp.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from datetime import datetime
+
+from flask import abort, current_app, request
+from sqlalchemy import tuple_
+
+
+def page_size():
+    """Number of messages shown per page."""
+
+    return current_app.config['MESSAGES_PER_PAGE']
+
+
+def encode_key(sort_value, row_id):
+    """Opaque cursor for a row with this (sort value, id) key."""
+
+    raw = f"{sort_value}|{row_id}"
+    return urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def encode_cursor(message):
+    """Opaque cursor pointing just past `message`."""
+
+    return encode_key(message.timestamp.isoformat(), message.id)
+
+
+def decode_cursor(cursor, parse=datetime.fromisoformat):
+    """Turn a cursor back into a (sort value, id) pair, using `parse` on
+    the sort value; 400 if malformed."""
+
+    if not cursor:
+        return None
+
+    try:
+        raw = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        sort_value, row_id = raw.split('|')
+        return parse(sort_value), int(row_id)
+    except (Base64Error, UnicodeDecodeError, ValueError):
+        abort(400)
+
+
+def requested_cursor(parse=datetime.fromisoformat):
+    """The decoded `before` cursor from the querystring, if any."""
+
+    return decode_cursor(request.args.get('before'), parse)
+
+
+def older_than(timestamp_column, id_column, cursor):
+    """Filter criterion for rows strictly older than `cursor`."""
+
+    return tuple_(timestamp_column, id_column) < tuple_(*cursor)
+
+
+def split_page(items, limit, cursor=encode_cursor):
+    """Split `limit + 1` fetched items into (page, next cursor or None),
+    using `cursor` to encode the last item of the page."""
+
+    if len(items) > limit:
+        return items[:limit], cursor(items[limit - 1])
+
+    return items, None
+
+
+def newest_first(query, timestamp_column, id_column, before, limit):
+    """Fetch up to `limit` rows of `query` older than `before`, newest first."""
+
+    if before:
+        query = query.filter(older_than(timestamp_column, id_column, before))
+
+    return (query
+            .order_by(timestamp_column.desc(), id_column.desc())
+            .limit(limit)
+            .all())
+
+
+def paginate(query, timestamp_column, id_column, before=None, limit=None):
+    """Return one newest-first page of `query` and the cursor for the next."""
+
+    limit = limit or page_size()
+    items = newest_first(query, timestamp_column, id_column, before, limit + 1)
+
+    return split_page(items, limit)
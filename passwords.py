@@ -0,0 +1,120 @@
+"""Password hashing.
+
+bcrypt is slow on purpose (about 250ms at the default cost), and running it
+on the request thread ties up a worker for that long. Hashes and checks run
+instead in a pool of PASSWORD_HASH_WORKERS processes, so a burst of logins
+queues up there instead of taking every CPU away from page requests. With
+PASSWORD_HASH_WORKERS = 0 they run inline.
+
+The cost factor is BCRYPT_LOG_ROUNDS. A user who logs in with a hash made
+at another cost has it replaced with one at the current cost. Timings of
+each operation are kept in `hash_timings`.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+from time import perf_counter
+
+import bcrypt
+from flask import current_app, has_app_context
+
+from metrics import LatencyStats
+
+hash_timings = LatencyStats()
+
+# Like `db.app`: lets models hash passwords outside an app context
+_default_app = None
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode()
+
+
+def _check(hashed, password):
+    return bcrypt.checkpw(password, hashed)
+
+
+def hash_cost(hashed):
+    """The cost factor a bcrypt hash was made with ('$2b$12$...' -> 12)."""
+
+    return int(hashed.split('$')[2])
+
+
+class PasswordHasher:
+    """Runs bcrypt in a lazily started process pool."""
+
+    def __init__(self, rounds=12, workers=2):
+        self.rounds = rounds
+        self.workers = workers
+        self._pool = None
+        self._pool_pid = None
+        self._lock = Lock()
+
+    def _executor(self):
+        # A pool inherited across fork() belongs to the parent; start anew.
+        # Workers are spawned, not forked: forking a threaded app process
+        # would copy its pooled database sockets and any locks held mid-use
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _run(self, operation, fn, *args):
+        start = perf_counter()
+        if self.workers:
+            result = self._executor().submit(fn, *args).result()
+        else:
+            result = fn(*args)
+        hash_timings.record(operation, perf_counter() - start)
+        return result
+
+    def hash(self, password):
+        """bcrypt hash of `password` at the configured cost."""
+
+        return self._run('hash', _hash, password.encode(), self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match `hashed`?"""
+
+        return self._run('check', _check, hashed.encode(), password.encode())
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made at a different cost than the configured one?"""
+
+        return hash_cost(hashed) != self.rounds
+
+    def shutdown(self):
+        """Stop the worker processes, if any were started."""
+
+        with self._lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown()
+            self._pool = None
+
+
+def init_password_hasher(app):
+    """Set up password hashing for `app` from its config."""
+
+    global _default_app
+    _default_app = app
+
+    app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+    app.config.setdefault('PASSWORD_HASH_WORKERS', 2)
+
+    app.extensions['password_hasher'] = PasswordHasher(
+        rounds=app.config['BCRYPT_LOG_ROUNDS'],
+        workers=app.config['PASSWORD_HASH_WORKERS'])
+
+
+def password_hasher():
+    """The current app's PasswordHasher, following config changes."""
+
+    app = current_app if has_app_context() else _default_app
+    hasher = app.extensions['password_hasher']
+    hasher.rounds = app.config['BCRYPT_LOG_ROUNDS']
+    return hasher
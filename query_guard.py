@@ -0,0 +1,43 @@
+"""Guard against views that issue too many SQL statements.
+
+Set SQL_STATEMENT_LIMIT in the app config to the most statements any single
+request may run. Requests that go over raise TooManyStatements, which makes
+N+1 query regressions fail loudly in tests. Leave it as None to disable.
+"""
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class TooManyStatements(Exception):
+    """A request ran more SQL statements than SQL_STATEMENT_LIMIT allows."""
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    if has_request_context():
+        g.sql_statement_count = g.get('sql_statement_count', 0) + 1
+
+
+def install_query_guard(app):
+    """Count SQL statements per request on `app` and enforce the limit."""
+
+    app.config.setdefault('SQL_STATEMENT_LIMIT', None)
+
+    @app.before_request
+    def reset_statement_count():
+        g.sql_statement_count = 0
+
+    @app.after_request
+    def check_statement_count(resp):
+        limit = app.config['SQL_STATEMENT_LIMIT']
+        count = g.get('sql_statement_count', 0)
+
+        if limit is not None and count > limit:
+            raise TooManyStatements(
+                f"{request.method} {request.path} ran {count} SQL "
+                f"statements (limit {limit})")
+
+        return resp
@@ -0,0 +1,409 @@
+"""Username and message search.
+
+A leading-wildcard `LIKE '%q%'` can't use a B-tree index, so on Postgres
+with the pg_trgm extension available `users.username` gets a trigram GIN
+index, which serves `ILIKE '%q%'` directly, and results are ranked with
+similarity(). Anywhere else (SQLite, or Postgres without pg_trgm) an
+in-process trigram index of usernames answers the same queries with the
+same ranking.
+
+Message text is full-text searched: on Postgres through a GIN index over
+to_tsvector('english', text), elsewhere (SQLite) through an FTS5 table
+kept in step by triggers on messages. Results are ranked by relevance plus
+a recency boost and paged with score cursors.
+"""
+
+import re
+from collections import defaultdict
+from heapq import nsmallest
+from threading import Lock
+from time import monotonic
+
+from flask import current_app
+from sqlalchemy import DDL, Float, cast, event, extract, func, literal_column
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import column, table
+
+from models import db, User, Message
+from pagination import encode_key, newest_first, page_size, split_page
+
+TRIGRAM_EXTENSION_DDL = "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+TRIGRAM_INDEX_DDL = ("CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+                     "ON users USING gin (username gin_trgm_ops)")
+
+MESSAGE_TSVECTOR = "to_tsvector('english'::regconfig, text)"
+MESSAGE_TEXT_INDEX_DDL = ("CREATE INDEX IF NOT EXISTS ix_messages_text_fts "
+                          f"ON messages USING gin ({MESSAGE_TSVECTOR})")
+MESSAGE_FTS_TABLE_DDL = ("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts "
+                         "USING fts5(text, content='messages', "
+                         "content_rowid='id', tokenize='porter unicode61')")
+# The FTS5 external-content pattern: every write to messages, however it's
+# made (ORM, Core, seeding), is mirrored into messages_fts
+MESSAGE_FTS_TRIGGERS_DDL = (
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages "
+    "BEGIN "
+    "INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages "
+    "BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); "
+    "END",
+    # Only text is indexed, so like_count updates don't touch the index
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_update "
+    "AFTER UPDATE OF text ON messages "
+    "BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); "
+    "INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text); "
+    "END",
+)
+
+messages_fts = table('messages_fts', column('rowid'))
+
+
+##############################################################################
+# Postgres trigram index
+
+
+def pg_trgm_available(bind):
+    """Can pg_trgm be used (or installed) on this connection?"""
+
+    if bind.dialect.name != 'postgresql':
+        return False
+
+    return bind.execute(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    ).scalar() is not None
+
+
+def install_trigram_index(bind):
+    """Create the pg_trgm username index if the database supports it.
+
+    Returns True if the index is (now) in place.
+    """
+
+    if not pg_trgm_available(bind):
+        return False
+
+    bind.execute(DDL(TRIGRAM_EXTENSION_DDL))
+    bind.execute(DDL(TRIGRAM_INDEX_DDL))
+    return True
+
+
+@event.listens_for(User.__table__, 'after_create')
+def _create_trigram_index(target, connection, **kw):
+    install_trigram_index(connection)
+
+
+def uses_trigram_index():
+    """Is the Postgres trigram index installed for the current app?"""
+
+    found = current_app.extensions.get('trigram_search')
+
+    if found is None:
+        found = (db.engine.dialect.name == 'postgresql'
+                 and db.session.execute(
+                     "SELECT 1 FROM pg_indexes "
+                     "WHERE indexname = 'ix_users_username_trgm'"
+                 ).scalar() is not None)
+        current_app.extensions['trigram_search'] = found
+
+    return found
+
+
+##############################################################################
+# In-process trigram index
+
+
+def _words(text):
+    return re.findall(r'[^\W_]+', text.lower())
+
+
+def padded_trigrams(text):
+    """Trigrams of `text` the way pg_trgm builds them, for similarity()."""
+
+    grams = set()
+    for word in _words(text):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def similarity(a_grams, b_grams):
+    """pg_trgm-style similarity of two padded trigram sets."""
+
+    if not a_grams or not b_grams:
+        return 0.0
+    return len(a_grams & b_grams) / len(a_grams | b_grams)
+
+
+def substring_trigrams(text):
+    """Every 3-character run in `text`. If `q` is a substring of `name`,
+    all of q's substring trigrams are among name's."""
+
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class UsernameIndex:
+    """Trigram postings for usernames, used when pg_trgm isn't available."""
+
+    def __init__(self, rows=()):
+        self.names = {}
+        self.grams = {}
+        self.postings = defaultdict(set)
+        self.lock = Lock()
+        self.built_at = monotonic()
+
+        for user_id, username in rows:
+            self.add(user_id, username)
+
+    def add(self, user_id, username):
+        with self.lock:
+            self._discard(user_id)
+            self.names[user_id] = username
+            self.grams[user_id] = padded_trigrams(username)
+            for gram in substring_trigrams(username):
+                self.postings[gram].add(user_id)
+
+    def remove(self, user_id):
+        with self.lock:
+            self._discard(user_id)
+
+    def _discard(self, user_id):
+        username = self.names.pop(user_id, None)
+        if username is None:
+            return
+        del self.grams[user_id]
+        for gram in substring_trigrams(username):
+            self.postings[gram].discard(user_id)
+
+    def search(self, query, limit):
+        """The best `limit` IDs of usernames containing `query`, best match
+        first."""
+
+        needle = query.lower()
+        query_grams = padded_trigrams(query)
+
+        with self.lock:
+            grams = substring_trigrams(needle)
+            if grams:
+                candidates = set.intersection(
+                    *(self.postings.get(gram, set()) for gram in grams))
+            else:
+                candidates = set(self.names)
+
+            matches = [(-similarity(query_grams, self.grams[user_id]),
+                        self.names[user_id], user_id)
+                       for user_id in candidates
+                       if needle in self.names[user_id].lower()]
+
+        best = nsmallest(limit, matches)
+        return [user_id for _, _, user_id in best]
+
+
+_username_index = None
+
+
+def username_index():
+    """The process's index of active usernames, rebuilt every
+    USER_SEARCH_INDEX_TTL seconds to pick up changes made by other
+    processes."""
+
+    global _username_index
+
+    ttl = current_app.config['USER_SEARCH_INDEX_TTL']
+    if (_username_index is None
+            or monotonic() - _username_index.built_at > ttl):
+        _username_index = UsernameIndex(
+            db.session
+            .query(User.id, User.username)
+            .filter(User.deactivated.is_(False))
+            .all())
+
+    return _username_index
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def _index_username(mapper, connection, user):
+    if _username_index is not None:
+        _username_index.add(user.id, user.username)
+
+
+@event.listens_for(User, 'after_delete')
+def _unindex_username(mapper, connection, user):
+    if _username_index is not None:
+        _username_index.remove(user.id)
+
+
+##############################################################################
+# Search
+
+
+def _like_pattern(query):
+    escaped = (query.replace('\\', '\\\\')
+               .replace('%', '\\%')
+               .replace('_', '\\_'))
+    return f"%{escaped}%"
+
+
+def search_users(query, page=1, per_page=None):
+    """One page of users whose username contains `query`, best match first.
+
+    Returns (users, has_next_page).
+    """
+
+    per_page = per_page or current_app.config['USERS_PER_PAGE']
+    offset = (page - 1) * per_page
+
+    if uses_trigram_index():
+        users = (User
+                 .query
+                 .filter(User.username.ilike(_like_pattern(query), escape='\\'),
+                         User.deactivated.is_(False))
+                 .order_by(func.similarity(User.username, query).desc(),
+                           User.username)
+                 .offset(offset)
+                 .limit(per_page + 1)
+                 .all())
+        return users[:per_page], len(users) > per_page
+
+    # One past the page, so whether there's a next page comes from the
+    # same rows that are shown rather than from a count of all matches
+    page_ids = username_index().search(query, offset + per_page + 1)[offset:]
+    found = {user.id: user
+             for user in User.query.filter(User.id.in_(page_ids),
+                                           User.deactivated.is_(False))}
+
+    # Skip IDs deleted (or deactivated) since the index was built
+    users = [found[user_id] for user_id in page_ids if user_id in found]
+    return users[:per_page], len(users) > per_page
+
+
+def list_all_users(page=1, per_page=None):
+    """One page of every user, in signup order. Returns (users, has_next)."""
+
+    per_page = per_page or current_app.config['USERS_PER_PAGE']
+
+    users = (User
+             .query
+             .filter(User.deactivated.is_(False))
+             .order_by(User.id)
+             .offset((page - 1) * per_page)
+             .limit(per_page + 1)
+             .all())
+    return users[:per_page], len(users) > per_page
+
+
+##############################################################################
+# Message full-text index
+
+
+def install_message_search_index(bind):
+    """Create the message full-text index for this database, if missing."""
+
+    if bind.dialect.name == 'postgresql':
+        bind.execute(DDL(MESSAGE_TEXT_INDEX_DDL))
+    elif bind.dialect.name == 'sqlite':
+        bind.execute(DDL(MESSAGE_FTS_TABLE_DDL))
+        for trigger_ddl in MESSAGE_FTS_TRIGGERS_DDL:
+            bind.execute(DDL(trigger_ddl))
+        bind.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+
+@event.listens_for(Message.__table__, 'after_create')
+def _create_message_search_index(target, connection, **kw):
+    install_message_search_index(connection)
+
+
+@event.listens_for(Message.__table__, 'before_drop')
+def _drop_message_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute("DROP TABLE IF EXISTS messages_fts")
+
+
+def _uses_fts5():
+    return db.engine.dialect.name == 'sqlite'
+
+
+def rebuild_message_index():
+    """Re-sync the full-text index with the messages table, e.g. for rows
+    written before its triggers existed."""
+
+    if _uses_fts5():
+        db.session.execute(
+            "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+
+##############################################################################
+# Message search
+
+
+def _search_terms(query):
+    return re.findall(r'\w+', query)
+
+
+def _recency():
+    """Score added for how recent a message is: a message
+    MESSAGE_SEARCH_RECENCY_DAYS newer gains as much as a perfect match."""
+
+    horizon = current_app.config['MESSAGE_SEARCH_RECENCY_DAYS'] * 86400.0
+
+    if _uses_fts5():
+        epoch = (func.julianday(Message.timestamp) - 2440587.5) * 86400.0
+    else:
+        epoch = cast(extract('epoch', Message.timestamp), Float)
+
+    return epoch / horizon
+
+
+def _scored_matches(terms):
+    """Query of messages containing every term, and their score expression.
+
+    The score is left as an expression, not a subquery column, so the
+    cursor's predicate lands in the same WHERE as the match.
+    """
+
+    query = Message.query
+
+    if _uses_fts5():
+        # bm25() is negative, lower is better; map it onto [0, 1)
+        bm25 = func.bm25(literal_column('messages_fts'))
+        relevance = -bm25 / (1 - bm25)
+        match = literal_column('messages_fts').op('MATCH')(
+            ' '.join(f'"{term}"' for term in terms))
+        query = query.join(messages_fts, messages_fts.c.rowid == Message.id)
+    else:
+        tsquery = func.plainto_tsquery('english', ' '.join(terms))
+        tsvector = func.to_tsvector(literal_column("'english'::regconfig"),
+                                    Message.text)
+        # Normalization 32 scales ts_rank to rank / (rank + 1), i.e. [0, 1)
+        relevance = cast(func.ts_rank(tsvector, tsquery, 32), Float)
+        match = tsvector.op('@@')(tsquery)
+
+    return query.filter(match), relevance + _recency()
+
+
+def search_messages(query, before=None, limit=None):
+    """One page of messages matching `query`, best first.
+
+    `before` is a decoded (score, id) cursor. Returns a list of
+    (message, score) rows and the cursor for the next page.
+    """
+
+    limit = limit or page_size()
+    terms = _search_terms(query)
+    if not terms:
+        return [], None
+
+    matches, score = _scored_matches(terms)
+    rows = newest_first(
+        (matches
+         .add_columns(score.label('score'))
+         .options(joinedload(Message.user))),
+        score, Message.id, before, limit + 1)
+
+    return split_page(rows, limit,
+                      cursor=lambda row: encode_key(row.score, row.Message.id))
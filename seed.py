@@ -1,20 +1,228 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+Recreates the tables, then streams each CSV in chunks of --chunk-size rows,
+committing after each: by COPY FROM STDIN on Postgres, by executemany
+elsewhere (SQLite). Secondary indexes are dropped for the load and built
+once afterwards, sequences are moved past the loaded ids, and counters,
+timelines and the search index are rebuilt. On Postgres, foreign keys are
+also dropped until the end and then checked in one pass each, rather than
+by a trigger per loaded (or timeline) row.
 
+If the directory has a manifest.json (written by generator/create_csvs.py),
+each table is loaded from the shard files it lists, in order; otherwise
+from users.csv, messages.csv and follows.csv.
 
-db.drop_all()
-db.create_all()
+    python seed.py
+    python seed.py --dir /tmp/big --chunk-size 100000
+"""
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+import argparse
+import csv
+import io
+import json
+import os
+from itertools import islice
+from time import perf_counter
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+from sqlalchemy import inspect
+from sqlalchemy.schema import AddConstraint
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+from app import app, db
+from models import (User, Message, Follows, reconcile_counters,
+                    create_missing_indexes)
+from timeline import rebuild_timelines
+from search import (rebuild_message_index, install_trigram_index,
+                    install_message_search_index)
 
-db.session.commit()
+# Each table's name in the CSVs and its model, in foreign key order
+LOADS = (
+    ('users', User),
+    ('messages', Message),
+    ('follows', Follows),
+)
+
+# Built outside the model declarations (see search.py), so dropped by name
+SEARCH_INDEXES = ('ix_users_username_trgm', 'ix_messages_text_fts')
+
+
+##############################################################################
+# Indexes, constraints and sequences
+
+
+def drop_indexes():
+    """Drop secondary indexes, so loading doesn't maintain them row by row."""
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(bind=db.engine)
+
+    if db.engine.dialect.name == 'postgresql':
+        for name in SEARCH_INDEXES:
+            db.engine.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+def create_indexes():
+    create_missing_indexes()
+    install_trigram_index(db.engine)
+    install_message_search_index(db.engine)
+
+
+def foreign_keys():
+    return [constraint for table in db.metadata.sorted_tables
+            for constraint in table.foreign_key_constraints]
+
+
+def drop_foreign_keys():
+    if db.engine.dialect.name != 'postgresql':
+        return
+
+    # The models leave them unnamed, so find the names Postgres gave them
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        for constraint in inspector.get_foreign_keys(table.name):
+            db.engine.execute(f"ALTER TABLE {table.name} "
+                              f"DROP CONSTRAINT {constraint['name']}")
+
+
+def create_foreign_keys():
+    if db.engine.dialect.name == 'postgresql':
+        for constraint in foreign_keys():
+            db.engine.execute(AddConstraint(constraint))
+
+
+def resync_sequences():
+    """Point Postgres id sequences past the highest loaded id, in case the
+    CSVs carried their own ids."""
+
+    if db.engine.dialect.name != 'postgresql':
+        return
+
+    for table in db.metadata.sorted_tables:
+        if 'id' in table.c and table.c.id.primary_key:
+            db.engine.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"COALESCE(MAX(id), 0) + 1, false) FROM {table.name}")
+
+
+##############################################################################
+# Loading
+
+
+def table_files(directory, name):
+    """Paths of the CSVs holding table `name`, in load order."""
+
+    manifest_path = os.path.join(directory, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return [os.path.join(directory, f"{name}.csv")]
+
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    return [os.path.join(directory, filename)
+            for filename in manifest['tables'][name]['files']]
+
+
+def csv_chunks(path, chunk_size):
+    """The CSV's header, then lists of up to `chunk_size` rows."""
+
+    with open(path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        yield next(reader)
+        while True:
+            rows = list(islice(reader, chunk_size))
+            if not rows:
+                return
+            yield rows
+
+
+def copy_rows(cursor, table, columns, rows):
+    """Postgres: send the rows through COPY FROM STDIN."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) "
+                       f"FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def insert_rows(cursor, table, columns, rows):
+    """Anything else: a plain DBAPI executemany."""
+
+    marker = '?' if db.engine.dialect.paramstyle == 'qmark' else '%s'
+    cursor.executemany(
+        f"INSERT INTO {table.name} ({', '.join(columns)}) "
+        f"VALUES ({', '.join([marker] * len(columns))})", rows)
+
+
+def load_csv(path, model, chunk_size):
+    """Stream one CSV into `model`'s table, committing each chunk. Returns
+    the number of rows loaded."""
+
+    table = model.__table__
+    write = copy_rows if db.engine.dialect.name == 'postgresql' else insert_rows
+    loaded = 0
+
+    connection = db.engine.raw_connection()
+    try:
+        chunks = csv_chunks(path, chunk_size)
+        columns = next(chunks)
+        for rows in chunks:
+            cursor = connection.cursor()
+            write(cursor, table, columns, rows)
+            cursor.close()
+            connection.commit()
+            loaded += len(rows)
+    finally:
+        connection.close()
+
+    return loaded
+
+
+def seed(directory, chunk_size):
+    db.drop_all()
+    db.create_all()
+    drop_indexes()
+    drop_foreign_keys()
+
+    for name, model in LOADS:
+        start = perf_counter()
+        paths = table_files(directory, name)
+        loaded = sum(load_csv(path, model, chunk_size) for path in paths)
+        elapsed = perf_counter() - start
+        print(f"Loaded {loaded} {name} from {len(paths)} file(s) in "
+              f"{elapsed:.1f} s ({loaded / max(elapsed, 1e-9):,.0f} rows/s)")
+
+    start = perf_counter()
+    create_indexes()
+    resync_sequences()
+    if db.engine.dialect.name == 'postgresql':
+        # Fresh statistics, so the rebuilds below get sensible plans
+        db.engine.execute("ANALYZE")
+    print(f"Built indexes and statistics in {perf_counter() - start:.1f} s")
+
+    start = perf_counter()
+    with app.app_context():
+        reconcile_counters()
+        rebuild_timelines()
+        rebuild_message_index()
+        db.session.commit()
+    print(f"Rebuilt counters, timelines and search in "
+          f"{perf_counter() - start:.1f} s")
+
+    start = perf_counter()
+    create_foreign_keys()
+    print(f"Checked foreign keys in {perf_counter() - start:.1f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dir', default='generator',
+                        help="directory holding the CSVs")
+    parser.add_argument('--chunk-size', type=int, default=50000,
+                        help="rows per COPY/executemany and commit")
+    args = parser.parse_args()
+
+    seed(args.dir, args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Follow and like actions, shared by the HTML and JSON routes.
+
+Each one writes the row (idempotently), keeps the home timeline in step,
+commits, and retires whatever cached identity or fragments it made stale.
+They return True if anything changed.
+"""
+
+from flask import g
+
+from fragments import forget_message, forget_user
+from identity import forget_identity
+from models import db, follow, unfollow, like, unlike
+from timeline import add_author, remove_author, restore_authors
+
+
+def liked_ids(messages):
+    """Set of IDs among `messages` that the current user has liked."""
+
+    if not g.user:
+        return set()
+
+    return g.user.liked_message_ids(message.id for message in messages)
+
+
+def follow_user(user_id, followed_id):
+    """`user_id` follows `followed_id`."""
+
+    if not follow(user_id, followed_id):
+        return False
+
+    add_author(user_id, followed_id)
+    db.session.commit()
+    forget_identity(user_id, followed_id)
+    forget_user(user_id, followed_id)
+    return True
+
+
+def unfollow_user(user_id, followed_id):
+    """`user_id` stops following `followed_id`."""
+
+    if not unfollow(user_id, followed_id):
+        return False
+
+    remove_author(user_id, followed_id)
+    restore_authors([followed_id])
+    db.session.commit()
+    forget_identity(user_id, followed_id)
+    forget_user(user_id, followed_id)
+    return True
+
+
+def like_message(user_id, message_id):
+    """`user_id` likes `message_id`."""
+
+    if not like(user_id, message_id):
+        return False
+
+    db.session.commit()
+    forget_identity(user_id)
+    forget_user(user_id)
+    forget_message(message_id)
+    return True
+
+
+def unlike_message(user_id, message_id):
+    """`user_id` stops liking `message_id`."""
+
+    if not unlike(user_id, message_id):
+        return False
+
+    db.session.commit()
+    forget_identity(user_id)
+    forget_user(user_id)
+    forget_message(message_id)
+    return True
@@ -0,0 +1,69 @@
+"""Fingerprinted URLs for static files.
+
+At startup every file under the static folder is hashed into a manifest.
+Templates link to assets with `static_url('stylesheets/style.css')`, which
+adds the file's hash as `?v=...`; http_cache serves such URLs as immutable
+for a year, and a changed file gets a new hash and so a new URL. There's no
+build step: restarting the app picks up changed files.
+"""
+
+import os
+from hashlib import sha256
+
+from flask import current_app, url_for
+
+STATIC_PREFIX = '/static/'
+
+
+def file_hash(path):
+    """Short content hash of the file at `path`."""
+
+    digest = sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def build_manifest(static_folder):
+    """Map each static filename (relative, '/'-separated) to its hash."""
+
+    manifest = {}
+    for root, _, files in os.walk(static_folder):
+        for name in files:
+            if name.endswith(('.gz', '.br')):
+                # Precompressed copies are served under their source's URL
+                continue
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, static_folder).replace(os.sep, '/')
+            manifest[filename] = file_hash(path)
+    return manifest
+
+
+def static_url(filename):
+    """URL for a static file with its content hash appended.
+
+    Also accepts a '/static/...' path, so stored image URLs can be passed
+    straight through; anything not in the manifest (e.g. an external image
+    URL) is returned unfingerprinted, and an empty one is left empty.
+    """
+
+    if not filename:
+        return filename
+    elif filename.startswith(STATIC_PREFIX):
+        filename = filename[len(STATIC_PREFIX):]
+    elif '://' in filename:
+        return filename
+
+    version = current_app.extensions['static_manifest'].get(filename)
+    if version is None:
+        return url_for('static', filename=filename)
+
+    return url_for('static', filename=filename, v=version)
+
+
+def init_static_assets(app):
+    """Hash `app`'s static files and make static_url() available to templates."""
+
+    app.extensions['static_manifest'] = build_manifest(app.static_folder)
+    app.add_template_global(static_url)
@@ -0,0 +1,155 @@
+"""JSON API View tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_api_views.py
+
+
+import os
+from unittest import TestCase
+from flask import url_for
+from models import db, Message, User, Likes, Follows, datetime
+from timeline import rebuild_timelines
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+db.drop_all()
+db.create_all()
+
+# Fail any view that regresses into issuing a query per rendered row
+app.config['SQL_STATEMENT_LIMIT'] = 10
+
+# In case autocorrect changes order of imporation
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///warbler-test'
+
+
+class ApiViewTestCase(TestCase):
+    """Test views for the JSON API."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+
+        self.app_context = app.test_request_context()
+        self.app_context.push()
+        self.client = app.test_client()
+
+        self.testuser = User.signup(
+            username="testuser", email="test@test.com", password="testuser", image_url=None)
+        self.testuser_2 = User.signup(
+            username="testinguser", email="testing@testing.com", password="testinguser", image_url=None)
+        db.session.commit()
+
+        self.testmsg = Message(text="Old news", user_id=self.testuser_2.id,
+                               timestamp=datetime(2020, 1, 1))
+        self.testmsg_2 = Message(text="Fresh news", user_id=self.testuser_2.id,
+                                 timestamp=datetime(2020, 1, 2))
+        db.session.add_all([self.testmsg, self.testmsg_2])
+        db.session.add(Follows(user_being_followed_id=self.testuser_2.id,
+                               user_following_id=self.testuser.id))
+        db.session.commit()
+        db.session.add(Likes(user_id=self.testuser.id, message_id=self.testmsg.id))
+        rebuild_timelines()
+        db.session.commit()
+
+    def tearDown(self):
+        """Clear any fouled transactions"""
+        db.session.rollback()
+
+    def login(self, c, user):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+    def test_timeline_paging(self):
+        """Does the timeline come back a page at a time, with authors listed once?"""
+
+        with self.client as c:
+            resp = c.get(url_for('api.timeline'))
+            self.assertEqual(resp.status_code, 401)
+
+            self.login(c, self.testuser)
+            resp = c.get(url_for('api.timeline', limit=1))
+            data = resp.get_json()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn(b', ', resp.get_data())
+            self.assertEqual([m['text'] for m in data['messages']], ["Fresh news"])
+            self.assertEqual(data['users'][str(self.testuser_2.id)]['username'], "testinguser")
+
+            data = c.get(url_for('api.timeline', limit=1, before=data['next'])).get_json()
+            self.assertEqual(data['messages'][0]['text'], "Old news")
+            self.assertTrue(data['messages'][0]['liked'])
+            self.assertNotIn('next', data)
+
+    def test_field_selection(self):
+        """Can clients ask for just the fields they need?"""
+
+        with self.client as c:
+            data = c.get(url_for('api.user_messages_feed', user_id=self.testuser_2.id,
+                                 fields='id,text')).get_json()
+            self.assertEqual(data['messages'][0], {'id': self.testmsg_2.id, 'text': "Fresh news"})
+            self.assertNotIn('users', data)
+
+            data = c.get(url_for('api.user_profile', user_id=self.testuser_2.id,
+                                 fields='username,follower_count')).get_json()
+            self.assertEqual(data, {'username': "testinguser", 'follower_count': 1})
+
+            resp = c.get(url_for('api.user_profile', user_id=self.testuser_2.id, fields='password'))
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn('password', resp.get_json()['error'])
+
+    def test_conditional_get(self):
+        """Is an unchanged response answered with 304?"""
+
+        with self.client as c:
+            url = url_for('api.user_profile', user_id=self.testuser_2.id)
+            resp = c.get(url)
+            resp = c.get(url, headers={'If-None-Match': resp.headers['ETag']})
+            self.assertEqual(resp.status_code, 304)
+
+    def test_follow_and_like(self):
+        """Do follow/like mutations apply once, and refuse bad targets?"""
+
+        with self.client as c:
+            self.login(c, self.testuser_2)
+
+            for _ in range(2):
+                resp = c.put(url_for('api.follow', user_id=self.testuser.id))
+                self.assertEqual(resp.get_json(), {'following': True})
+                resp = c.put(url_for('api.like', message_id=self.testmsg.id))
+                self.assertEqual(resp.status_code, 403)
+
+            self.assertEqual(User.query.get(self.testuser.id).follower_count, 1)
+
+            resp = c.delete(url_for('api.follow', user_id=self.testuser.id))
+            self.assertEqual(resp.get_json(), {'following': False})
+            self.assertEqual(User.query.get(self.testuser.id).follower_count, 0)
+
+            resp = c.put(url_for('api.follow', user_id=0))
+            self.assertEqual(resp.status_code, 404)
+            resp = c.put(url_for('api.follow', user_id=self.testuser_2.id))
+            self.assertEqual(resp.status_code, 403)
+
+            self.testuser.deactivated = True
+            db.session.commit()
+            resp = c.put(url_for('api.follow', user_id=self.testuser.id))
+            self.assertEqual(resp.status_code, 404)
+            self.testuser.deactivated = False
+            db.session.commit()
+
+            self.login(c, self.testuser)
+            resp = c.delete(url_for('api.like', message_id=self.testmsg.id))
+            self.assertEqual(resp.get_json(), {'liked': False})
+            self.assertEqual(Message.query.get(self.testmsg.id).like_count, 0)
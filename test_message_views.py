@@ -8,7 +8,8 @@
 import os
 from unittest import TestCase
 from flask import url_for
-from models import db, Message, User, Likes, Follows, datetime
+from models import db, Message, User, Likes, Follows, TimelineEntry, datetime
+from static_assets import static_url
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -36,6 +37,9 @@ app.config['WTF_CSRF_ENABLED'] = False
 # Prevents any redirects from happening even if tests are run in development mode
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
+# Fail any view that regresses into issuing a query per rendered row
+app.config['SQL_STATEMENT_LIMIT'] = 10
+
 # In case autocorrect changes order of imporation
 app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///warbler-test'
 
@@ -143,6 +147,179 @@ class MessageViewTestCase(TestCase):
                 '<div class="alert alert-success">Created message</div>', html)
             self.assertNotIn('<div class="alert alert-danger>', html)
 
+    def test_add_message_timeline(self):
+        """Does a new message get pushed to the author's followers?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_2.id
+
+            c.post(url_for('messages_add'), data={"text": "Fanned out"})
+            msg = Message.query.order_by(Message.id.desc()).first()
+
+            owners = {entry.user_id for entry in
+                      TimelineEntry.query.filter_by(message_id=msg.id)}
+            self.assertEqual(owners, {self.testuser.id, self.testuser_2.id})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get(url_for('homepage'))
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<p>Fanned out</p>', html)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_2.id
+
+            c.post(url_for('messages_destroy', message_id=msg.id))
+            self.assertEqual(
+                TimelineEntry.query.filter_by(message_id=msg.id).count(), 0)
+
+    def test_delete_liked_message(self):
+        """Do likers' cached like counts drop when a message they liked is deleted?"""
+
+        likes_link = f'<a href="/users/{self.testuser_2.id}/likes">'
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get(url_for('users_show', user_id=self.testuser_2.id)).get_data(as_text=True)
+            self.assertIn(f'{likes_link}1</a>', html)
+
+            c.post(url_for('messages_destroy', message_id=self.testmsg_2.id))
+
+            html = c.get(url_for('users_show', user_id=self.testuser_2.id)).get_data(as_text=True)
+            self.assertIn(f'{likes_link}0</a>', html)
+
+    def test_add_message_celebrity(self):
+        """Are messages from high-follower users pulled instead of pushed?"""
+
+        app.config['CELEBRITY_FOLLOWER_THRESHOLD'] = 1
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_2.id
+
+                c.post(url_for('messages_add'), data={"text": "Pulled in"})
+                msg = Message.query.order_by(Message.id.desc()).first()
+
+                owners = {entry.user_id for entry in
+                          TimelineEntry.query.filter_by(message_id=msg.id)}
+                self.assertEqual(owners, {self.testuser_2.id})
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                resp = c.get(url_for('homepage'))
+                html = resp.get_data(as_text=True)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('<p>Pulled in</p>', html)
+                self.assertIn(f'<p>{self.testmsg_4.text}</p>', html)
+        finally:
+            app.config['CELEBRITY_FOLLOWER_THRESHOLD'] = 10000
+
+    def test_celebrity_drops_below_threshold(self):
+        """Are messages posted while pulled pushed to followers once the author stops being a celebrity?"""
+
+        fan = User.signup(username="fan", email="fan@test.com", password="fanfan", image_url=None)
+        db.session.commit()
+        app.config['CELEBRITY_FOLLOWER_THRESHOLD'] = 2
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = fan.id
+                c.post(url_for('add_follow', follow_id=self.testuser_2.id))
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_2.id
+                c.post(url_for('messages_add'), data={"text": "Famous for a while"})
+                msg = Message.query.filter_by(text="Famous for a while").one()
+                self.assertEqual(TimelineEntry.query.filter_by(message_id=msg.id).count(), 1)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = fan.id
+                c.post(url_for('stop_following', follow_id=self.testuser_2.id))
+
+                self.assertEqual(
+                    {entry.user_id for entry in TimelineEntry.query.filter_by(message_id=msg.id)},
+                    {self.testuser_2.id, self.testuser.id})
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+                html = c.get(url_for('homepage')).get_data(as_text=True)
+                self.assertIn('<p>Famous for a while</p>', html)
+        finally:
+            app.config['CELEBRITY_FOLLOWER_THRESHOLD'] = 10000
+
+    def test_search_messages(self):
+        """Does message search find matching messages, best first, a page at a time?"""
+
+        db.session.add_all([
+            Message(text="Penguins waddle", user_id=self.testuser.id,
+                    timestamp=datetime(2020, 1, 1)),
+            Message(text="Penguin facts", user_id=self.testuser_2.id,
+                    timestamp=datetime(2020, 1, 2)),
+            Message(text="Otters swim", user_id=self.testuser_2.id),
+        ])
+        db.session.commit()
+        app.config['MESSAGES_PER_PAGE'] = 1
+
+        try:
+            with self.client as c:
+                resp = c.get(url_for('messages_search', q='penguin'))
+                html = resp.get_data(as_text=True)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('<p>Penguin facts</p>', html)
+                self.assertNotIn('<p>Penguins waddle</p>', html)
+                self.assertNotIn('<p>Otters swim</p>', html)
+                self.assertIn('id="more-results"', html)
+
+                cursor = html.split('before=')[1].split('"')[0]
+                resp = c.get(url_for('messages_search', q='penguin', before=cursor))
+                html = resp.get_data(as_text=True)
+
+                self.assertIn('<p>Penguins waddle</p>', html)
+                self.assertNotIn('<p>Penguin facts</p>', html)
+                self.assertNotIn('id="more-results"', html)
+
+                resp = c.get(url_for('messages_search', q='walrus'))
+                self.assertIn('Sorry, no messages found', resp.get_data(as_text=True))
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+    def test_cached_cards_refresh(self):
+        """Do cached message cards and profile stats update after an unlike?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_2.id
+
+            msg_id = self.testmsg_2.id
+            stats_url = url_for('users_show', user_id=self.testuser_2.id)
+            likes_link = f'<a href="/users/{self.testuser_2.id}/likes">{{}}</a>'
+
+            for _ in range(2):
+                html = c.get(url_for('users_show', user_id=self.testuser.id)).get_data(as_text=True)
+                self.assertIn(f'action="/users/remove_like/{msg_id}"', html)
+                html = c.get(stats_url).get_data(as_text=True)
+                self.assertIn(likes_link.format(1), html)
+
+            resp = c.post(url_for('remove_like', message_id=msg_id))
+            self.assertEqual(resp.status_code, 302)
+
+            html = c.get(url_for('users_show', user_id=self.testuser.id)).get_data(as_text=True)
+            self.assertIn(f'action="/users/add_like/{msg_id}"', html)
+            self.assertNotIn(f'action="/users/remove_like/{msg_id}"', html)
+            html = c.get(stats_url).get_data(as_text=True)
+            self.assertIn(likes_link.format(0), html)
+
     def test_view_message_non_user(self):
         """Can view a specific message as a non-user?"""
 
@@ -158,7 +335,7 @@ class MessageViewTestCase(TestCase):
             self.assertIn(
                 f'<a href="{url_for("users_show", user_id=msg.user_id)}"', html)
             self.assertIn(
-                f'<img src="{msg.user.image_url}" alt="{msg.user.username} image"', html)
+                f'<img src="{static_url(msg.user.image_url)}" alt="{msg.user.username} image"', html)
             self.assertIn(
                 f'<a href="/users/{msg.user.id}">@{msg.user.username}</a>', html)
             self.assertNotIn(
@@ -195,7 +372,7 @@ class MessageViewTestCase(TestCase):
             self.assertIn(
                 f'<a href="{url_for("users_show", user_id=msg.user_id)}"', html)
             self.assertIn(
-                f'<img src="{msg.user.image_url}" alt="{msg.user.username} image', html)
+                f'<img src="{static_url(msg.user.image_url)}" alt="{msg.user.username} image', html)
             self.assertIn(
                 f'<a href="/users/{msg.user.id}">@{msg.user.username}</a>', html)
             self.assertIn(
@@ -233,7 +410,7 @@ class MessageViewTestCase(TestCase):
             self.assertIn(
                 f'<a href="{url_for("users_show", user_id=msg.user_id)}"', html)
             self.assertIn(
-                f'<img src="{msg.user.image_url}" alt="{msg.user.username} image', html)
+                f'<img src="{static_url(msg.user.image_url)}" alt="{msg.user.username} image', html)
             self.assertIn(
                 f'<a href="/users/{msg.user.id}">@{msg.user.username}</a>', html)
             self.assertNotIn(
@@ -270,7 +447,7 @@ class MessageViewTestCase(TestCase):
             self.assertIn(
                 f'<a href="{url_for("users_show", user_id=msg.user_id)}"', html)
             self.assertIn(
-                f'<img src="{msg.user.image_url}" alt="{msg.user.username} image', html)
+                f'<img src="{static_url(msg.user.image_url)}" alt="{msg.user.username} image', html)
             self.assertIn(
                 f'<a href="/users/{msg.user.id}">@{msg.user.username}</a>', html)
             self.assertNotIn(
@@ -307,7 +484,7 @@ class MessageViewTestCase(TestCase):
             self.assertIn(
                 f'<a href="{url_for("users_show", user_id=msg.user_id)}"', html)
             self.assertIn(
-                f'<img src="{msg.user.image_url}" alt="{msg.user.username} image', html)
+                f'<img src="{static_url(msg.user.image_url)}" alt="{msg.user.username} image', html)
             self.assertIn(
                 f'<a href="/users/{msg.user.id}">@{msg.user.username}</a>', html)
             self.assertNotIn(
@@ -345,7 +522,7 @@ class MessageViewTestCase(TestCase):
             self.assertIn(
                 f'<a href="{url_for("users_show", user_id=msg.user_id)}"', html)
             self.assertIn(
-                f'<img src="{msg.user.image_url}" alt="{msg.user.username} image', html)
+                f'<img src="{static_url(msg.user.image_url)}" alt="{msg.user.username} image', html)
             self.assertIn(
                 f'<a href="/users/{msg.user.id}">@{msg.user.username}</a>', html)
             self.assertNotIn(
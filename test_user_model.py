@@ -8,7 +8,9 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from models import (db, User, Message, Follows, Likes, reconcile_counters,
+                    follow, unfollow, like, unlike)
+from passwords import hash_cost, hash_timings
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -63,3 +65,131 @@ class UserModelTestCase(TestCase):
         # User should have no messages & no followers
         self.assertEqual(len(u.messages), 0)
         self.assertEqual(len(u.followers), 0)
+
+    def test_user_counters(self):
+        """Are follower/following/message/like counters kept in step?"""
+
+        u1 = User.signup("testuser", "test@test.com", "password", None)
+        u2 = User.signup("otheruser", "other@test.com", "password", None)
+        db.session.commit()
+
+        msg = Message(text="Counted", user_id=u2.id)
+        db.session.add(msg)
+        db.session.add(Follows(user_being_followed_id=u2.id,
+                               user_following_id=u1.id))
+        db.session.commit()
+        db.session.add(Likes(user_id=u1.id, message_id=msg.id))
+        db.session.commit()
+
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u1.like_count, 1)
+        self.assertEqual(u2.follower_count, 1)
+        self.assertEqual(u2.message_count, 1)
+        self.assertEqual(msg.like_count, 1)
+
+        User.query.update({User.follower_count: 42,
+                           User.like_count: 42})
+        db.session.commit()
+        reconcile_counters()
+        db.session.commit()
+
+        self.assertEqual(u1.like_count, 1)
+        self.assertEqual(u2.follower_count, 1)
+        self.assertEqual(u2.like_count, 0)
+
+        db.session.delete(msg)
+        db.session.commit()
+
+        self.assertEqual(u1.like_count, 0)
+        self.assertEqual(u2.message_count, 0)
+
+    def test_idempotent_follow_and_like(self):
+        """Do repeated follows/likes write once and keep counters exact?"""
+
+        u1 = User.signup("testuser", "test@test.com", "password", None)
+        u2 = User.signup("otheruser", "other@test.com", "password", None)
+        db.session.commit()
+        msg = Message(text="Hello", user_id=u2.id)
+        own = Message(text="Mine", user_id=u1.id)
+        db.session.add_all([msg, own])
+        db.session.commit()
+
+        self.assertTrue(follow(u1.id, u2.id))
+        self.assertFalse(follow(u1.id, u2.id))
+        self.assertFalse(follow(u1.id, -1))
+        self.assertTrue(like(u1.id, msg.id))
+        self.assertFalse(like(u1.id, msg.id))
+        self.assertFalse(like(u1.id, own.id))
+        db.session.commit()
+
+        self.assertEqual(Follows.query.count(), 1)
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual((u1.following_count, u2.follower_count), (1, 1))
+        self.assertEqual((u1.like_count, msg.like_count, own.like_count), (1, 1, 0))
+
+        self.assertTrue(unfollow(u1.id, u2.id))
+        self.assertFalse(unfollow(u1.id, u2.id))
+        self.assertTrue(unlike(u1.id, msg.id))
+        self.assertFalse(unlike(u1.id, msg.id))
+        db.session.commit()
+
+        self.assertEqual((u1.following_count, u2.follower_count), (0, 0))
+        self.assertEqual((u1.like_count, msg.like_count), (0, 0))
+
+    def test_is_following(self):
+        """Do is_following/is_followed_by reflect follows, including after changes?"""
+
+        u1 = User.signup("testuser", "test@test.com", "password", None)
+        u2 = User.signup("otheruser", "other@test.com", "password", None)
+        db.session.commit()
+
+        self.assertFalse(u1.is_following(u2))
+        self.assertFalse(u2.is_followed_by(u1))
+
+        db.session.add(Follows(user_being_followed_id=u2.id,
+                               user_following_id=u1.id))
+        db.session.commit()
+
+        self.assertTrue(u1.is_following(u2))
+        self.assertTrue(u2.is_followed_by(u1))
+        self.assertFalse(u2.is_following(u1))
+        self.assertFalse(u1.is_followed_by(u2))
+
+    def test_liked_message_ids(self):
+        """Does liked_message_ids only report likes among the given messages?"""
+
+        u1 = User.signup("testuser", "test@test.com", "password", None)
+        u2 = User.signup("otheruser", "other@test.com", "password", None)
+        db.session.commit()
+
+        msgs = [Message(text=f"Message {i}", user_id=u2.id) for i in range(3)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        db.session.add(Likes(user_id=u1.id, message_id=msgs[0].id))
+        db.session.add(Likes(user_id=u1.id, message_id=msgs[2].id))
+        db.session.commit()
+
+        self.assertEqual(u1.liked_message_ids([msgs[0].id, msgs[1].id]),
+                         {msgs[0].id})
+        self.assertEqual(u1.liked_message_ids([]), set())
+        self.assertEqual(u2.liked_message_ids(m.id for m in msgs), set())
+
+    def test_authenticate_rehashes(self):
+        """Is a password hashed at an old cost rehashed on login?"""
+
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        try:
+            u = User.signup("testuser", "test@test.com", "password", None)
+            db.session.commit()
+            self.assertEqual(hash_cost(u.password), 4)
+
+            app.config['BCRYPT_LOG_ROUNDS'] = 5
+            self.assertFalse(User.authenticate("testuser", "wrong"))
+            self.assertEqual(hash_cost(u.password), 4)
+
+            self.assertEqual(User.authenticate("testuser", "password"), u)
+            self.assertEqual(hash_cost(u.password), 5)
+            self.assertIs(User.authenticate("testuser", "password"), u)
+            self.assertIn('check', hash_timings.summary())
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = 12
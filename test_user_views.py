@@ -1,7 +1,14 @@
+import gzip
 import os
+import tempfile
 from unittest import TestCase
-from flask import url_for
-from models import db, Message, User, Likes, Follows, datetime
+from flask import Flask, render_template_string, url_for
+from models import db, Message, User, Likes, Follows, TimelineEntry, datetime
+from timeline import rebuild_timelines
+from pagination import encode_cursor
+from instrumentation import install_instrumentation, request_stats
+from static_assets import static_url
+from compression import precompress_static
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -29,6 +36,13 @@ app.config['WTF_CSRF_ENABLED'] = False
 # Prevents any redirects from happening even if tests are run in development mode
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
+# Fail any view that regresses into issuing a query per rendered row
+app.config['SQL_STATEMENT_LIMIT'] = 10
+
+# setUp bulk-deletes users behind the in-process username index's back,
+# so rebuild it on every search
+app.config['USER_SEARCH_INDEX_TTL'] = 0
+
 # In case autocorrect changes order of imporation
 app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///warbler-test'
 
@@ -112,18 +126,18 @@ class UserModelTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn('<div class="alert', html)
-            self.assertIn(f'<img src="{self.testuser.header_image_url}" alt=""', html)
-            self.assertIn(f'<img src="{self.testuser_2.header_image_url}" alt=""', html)
-            self.assertIn(f'<img src="{self.testuser_3.header_image_url}" alt=""', html)
-            self.assertIn(f'<img src="{self.testuser_4.header_image_url}" alt=""', html)
+            self.assertIn(f'<img src="{static_url(self.testuser.header_image_url)}" alt=""', html)
+            self.assertIn(f'<img src="{static_url(self.testuser_2.header_image_url)}" alt=""', html)
+            self.assertIn(f'<img src="{static_url(self.testuser_3.header_image_url)}" alt=""', html)
+            self.assertIn(f'<img src="{static_url(self.testuser_4.header_image_url)}" alt=""', html)
             self.assertIn(f'<a href="/users/{self.testuser.id}"', html)
             self.assertIn(f'<a href="/users/{self.testuser_2.id}"', html)
             self.assertIn(f'<a href="/users/{self.testuser_3.id}"', html)
             self.assertIn(f'<a href="/users/{self.testuser_4.id}"', html)
-            self.assertIn(f'<img src="{self.testuser.image_url}" alt="{self.testuser.username} Image"', html)
-            self.assertIn(f'<img src="{self.testuser_2.image_url}" alt="{self.testuser_2.username} Image"', html)
-            self.assertIn(f'<img src="{self.testuser_3.image_url}" alt="{self.testuser_3.username} Image"', html)
-            self.assertIn(f'<img src="{self.testuser_4.image_url}" alt="{self.testuser_4.username} Image"', html)
+            self.assertIn(f'<img src="{static_url(self.testuser.image_url)}" alt="{self.testuser.username} Image"', html)
+            self.assertIn(f'<img src="{static_url(self.testuser_2.image_url)}" alt="{self.testuser_2.username} Image"', html)
+            self.assertIn(f'<img src="{static_url(self.testuser_3.image_url)}" alt="{self.testuser_3.username} Image"', html)
+            self.assertIn(f'<img src="{static_url(self.testuser_4.image_url)}" alt="{self.testuser_4.username} Image"', html)
             self.assertIn(f'<p>@{self.testuser.username}</p>', html)
             self.assertIn(f'<p>@{self.testuser_2.username}</p>', html)
             self.assertIn(f'<p>@{self.testuser_3.username}</p>', html)
@@ -146,18 +160,18 @@ class UserModelTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn('<div class="alert', html)
-            self.assertIn(f'<img src="{self.testuser.header_image_url}" alt=""', html)
-            self.assertIn(f'<img src="{self.testuser_2.header_image_url}" alt=""', html)
-            self.assertIn(f'<img src="{self.testuser_3.header_image_url}" alt=""', html)
-            self.assertIn(f'<img src="{self.testuser_4.header_image_url}" alt=""', html)
+            self.assertIn(f'<img src="{static_url(self.testuser.header_image_url)}" alt=""', html)
+            self.assertIn(f'<img src="{static_url(self.testuser_2.header_image_url)}" alt=""', html)
+            self.assertIn(f'<img src="{static_url(self.testuser_3.header_image_url)}" alt=""', html)
+            self.assertIn(f'<img src="{static_url(self.testuser_4.header_image_url)}" alt=""', html)
             self.assertIn(f'<a href="/users/{self.testuser.id}"', html)
             self.assertIn(f'<a href="/users/{self.testuser_2.id}"', html)
             self.assertIn(f'<a href="/users/{self.testuser_3.id}"', html)
             self.assertIn(f'<a href="/users/{self.testuser_4.id}"', html)
-            self.assertIn(f'<img src="{self.testuser.image_url}" alt="{self.testuser.username} Image"', html)
-            self.assertIn(f'<img src="{self.testuser_2.image_url}" alt="{self.testuser_2.username} Image"', html)
-            self.assertIn(f'<img src="{self.testuser_3.image_url}" alt="{self.testuser_3.username} Image"', html)
-            self.assertIn(f'<img src="{self.testuser_4.image_url}" alt="{self.testuser_4.username} Image"', html)
+            self.assertIn(f'<img src="{static_url(self.testuser.image_url)}" alt="{self.testuser.username} Image"', html)
+            self.assertIn(f'<img src="{static_url(self.testuser_2.image_url)}" alt="{self.testuser_2.username} Image"', html)
+            self.assertIn(f'<img src="{static_url(self.testuser_3.image_url)}" alt="{self.testuser_3.username} Image"', html)
+            self.assertIn(f'<img src="{static_url(self.testuser_4.image_url)}" alt="{self.testuser_4.username} Image"', html)
             self.assertIn(f'<p>@{self.testuser.username}</p>', html)
             self.assertIn(f'<p>@{self.testuser_2.username}</p>', html)
             self.assertIn(f'<p>@{self.testuser_3.username}</p>', html)
@@ -175,6 +189,47 @@ class UserModelTestCase(TestCase):
             self.assertIn(f'<p class="card-bio">{self.testuser_3.bio}</p>', html)
             self.assertIn(f'<p class="card-bio">{self.testuser_4.bio}</p>', html)
 
+    def test_search_users(self):
+        """Does search match usernames case-insensitively, best match first, a page at a time?"""
+
+        with self.client as c:
+            resp = c.get(url_for('list_users', q="TESTUSER"))
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'<p>@{self.testuser.username}</p>', html)
+            self.assertIn(f'<p>@{self.testuser_3.username}</p>', html)
+            self.assertNotIn(f'<p>@{self.testuser_2.username}</p>', html)
+            self.assertNotIn(f'<p>@{self.testuser_4.username}</p>', html)
+            self.assertLess(html.index(f'<p>@{self.testuser.username}</p>'),
+                            html.index(f'<p>@{self.testuser_3.username}</p>'))
+
+            app.config['USERS_PER_PAGE'] = 1
+            try:
+                resp = c.get(url_for('list_users', q="testing", page=2))
+                html = resp.get_data(as_text=True)
+            finally:
+                app.config['USERS_PER_PAGE'] = 60
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'<p>@{self.testuser_4.username}</p>', html)
+            self.assertNotIn(f'<p>@{self.testuser_2.username}</p>', html)
+            self.assertIn('>Previous</a>', html)
+            self.assertNotIn('>Next</a>', html)
+
+            # A deactivated match mustn't leave a Next link to an empty page
+            self.testuser_4.deactivated = True
+            db.session.commit()
+            app.config['USERS_PER_PAGE'] = 1
+            try:
+                resp = c.get(url_for('list_users', q="testing"))
+                html = resp.get_data(as_text=True)
+            finally:
+                app.config['USERS_PER_PAGE'] = 60
+
+            self.assertIn(f'<p>@{self.testuser_2.username}</p>', html)
+            self.assertNotIn('>Next</a>', html)
+
     def test_show_user_non_user(self):
         """User shows up for non users?"""
 
@@ -184,8 +239,8 @@ class UserModelTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn('<div class="alert', html)
-            self.assertIn(f'style="background-image: url({self.testuser.header_image_url});"', html)
-            self.assertIn(f'<img src="{self.testuser.image_url}" alt="{self.testuser.username} image"', html)
+            self.assertIn(f'style="background-image: url({static_url(self.testuser.header_image_url)});"', html)
+            self.assertIn(f'<img src="{static_url(self.testuser.image_url)}" alt="{self.testuser.username} image"', html)
             self.assertIn(f'<a href="/users/{self.testuser.id}">{len(self.testuser.messages)}</a>', html)
             self.assertIn(f'<a href="/users/{self.testuser.id}/following">{len(self.testuser.following)}</a>', html)
             self.assertIn(f'<a href="/users/{self.testuser.id}/followers">{len(self.testuser.followers)}</a>', html)
@@ -197,7 +252,7 @@ class UserModelTestCase(TestCase):
             self.assertIn(f'<a href="/messages/{self.testmsg.id}"', html)
             self.assertIn(f'<a href="/messages/{self.testmsg_2.id}"', html)
             self.assertIn(f'<a href="/users/{self.testuser.id}"', html)
-            self.assertIn(f'<img src="{self.testuser.image_url}" alt="{self.testuser.username} image"', html)
+            self.assertIn(f'<img src="{static_url(self.testuser.image_url)}" alt="{self.testuser.username} image"', html)
             self.assertIn(f'<a href="/users/{self.testuser.id}">@{self.testuser.username}</a>', html)
             self.assertIn(f'<span class="text-muted">{self.testmsg.timestamp.strftime("%d %B %Y")}</span>', html)
             self.assertIn(f'<span class="text-muted">{self.testmsg_2.timestamp.strftime("%d %B %Y")}</span>', html)
@@ -220,8 +275,8 @@ class UserModelTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn('<div class="alert', html)
-            self.assertIn(f'style="background-image: url({self.testuser.header_image_url});"', html)
-            self.assertIn(f'<img src="{self.testuser.image_url}" alt="{self.testuser.username} image"', html)
+            self.assertIn(f'style="background-image: url({static_url(self.testuser.header_image_url)});"', html)
+            self.assertIn(f'<img src="{static_url(self.testuser.image_url)}" alt="{self.testuser.username} image"', html)
             self.assertIn(f'<a href="/users/{self.testuser.id}">{len(self.testuser.messages)}</a>', html)
             self.assertIn(f'<a href="/users/{self.testuser.id}/following">{len(self.testuser.following)}</a>', html)
             self.assertIn(f'<a href="/users/{self.testuser.id}/followers">{len(self.testuser.followers)}</a>', html)
@@ -233,7 +288,7 @@ class UserModelTestCase(TestCase):
             self.assertIn(f'<a href="/messages/{self.testmsg.id}"', html)
             self.assertIn(f'<a href="/messages/{self.testmsg_2.id}"', html)
             self.assertIn(f'<a href="/users/{self.testuser.id}"', html)
-            self.assertIn(f'<img src="{self.testuser.image_url}" alt="{self.testuser.username} image"', html)
+            self.assertIn(f'<img src="{static_url(self.testuser.image_url)}" alt="{self.testuser.username} image"', html)
             self.assertIn(f'<a href="/users/{self.testuser.id}">@{self.testuser.username}</a>', html)
             self.assertIn(f'<span class="text-muted">{self.testmsg.timestamp.strftime("%d %B %Y")}</span>', html)
             self.assertIn(f'<span class="text-muted">{self.testmsg_2.timestamp.strftime("%d %B %Y")}</span>', html)
@@ -256,8 +311,8 @@ class UserModelTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn('<div class="alert', html)
-            self.assertIn(f'style="background-image: url({self.testuser.header_image_url});"', html)
-            self.assertIn(f'<img src="{self.testuser.image_url}" alt="{self.testuser.username} image"', html)
+            self.assertIn(f'style="background-image: url({static_url(self.testuser.header_image_url)});"', html)
+            self.assertIn(f'<img src="{static_url(self.testuser.image_url)}" alt="{self.testuser.username} image"', html)
             self.assertIn(f'<a href="/users/{self.testuser.id}">{len(self.testuser.messages)}</a>', html)
             self.assertIn(f'<a href="/users/{self.testuser.id}/following">{len(self.testuser.following)}</a>', html)
             self.assertIn(f'<a href="/users/{self.testuser.id}/followers">{len(self.testuser.followers)}</a>', html)
@@ -269,7 +324,7 @@ class UserModelTestCase(TestCase):
             self.assertIn(f'<a href="/messages/{self.testmsg.id}"', html)
             self.assertIn(f'<a href="/messages/{self.testmsg_2.id}"', html)
             self.assertIn(f'<a href="/users/{self.testuser.id}"', html)
-            self.assertIn(f'<img src="{self.testuser.image_url}" alt="{self.testuser.username} image"', html)
+            self.assertIn(f'<img src="{static_url(self.testuser.image_url)}" alt="{self.testuser.username} image"', html)
             self.assertIn(f'<a href="/users/{self.testuser.id}">@{self.testuser.username}</a>', html)
             self.assertIn(f'<span class="text-muted">{self.testmsg.timestamp.strftime("%d %B %Y")}</span>', html)
             self.assertIn(f'<span class="text-muted">{self.testmsg_2.timestamp.strftime("%d %B %Y")}</span>', html)
@@ -292,8 +347,8 @@ class UserModelTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn('<div class="alert', html)
-            self.assertIn(f'style="background-image: url({self.testuser_2.header_image_url});"', html)
-            self.assertIn(f'<img src="{self.testuser_2.image_url}" alt="{self.testuser_2.username} image"', html)
+            self.assertIn(f'style="background-image: url({static_url(self.testuser_2.header_image_url)});"', html)
+            self.assertIn(f'<img src="{static_url(self.testuser_2.image_url)}" alt="{self.testuser_2.username} image"', html)
             self.assertIn(f'<a href="/users/{self.testuser_2.id}">{len(self.testuser_2.messages)}</a>', html)
             self.assertIn(f'<a href="/users/{self.testuser_2.id}/following">{len(self.testuser_2.following)}</a>', html)
             self.assertIn(f'<a href="/users/{self.testuser_2.id}/followers">{len(self.testuser_2.followers)}</a>', html)
@@ -305,7 +360,7 @@ class UserModelTestCase(TestCase):
             self.assertIn(f'<a href="/messages/{self.testmsg_3.id}"', html)
             self.assertIn(f'<a href="/messages/{self.testmsg_4.id}"', html)
             self.assertIn(f'<a href="/users/{self.testuser_2.id}"', html)
-            self.assertIn(f'<img src="{self.testuser_2.image_url}" alt="{self.testuser_2.username} image"', html)
+            self.assertIn(f'<img src="{static_url(self.testuser_2.image_url)}" alt="{self.testuser_2.username} image"', html)
             self.assertIn(f'<a href="/users/{self.testuser_2.id}">@{self.testuser_2.username}</a>', html)
             self.assertIn(f'<span class="text-muted">{self.testmsg_3.timestamp.strftime("%d %B %Y")}</span>', html)
             self.assertIn(f'<span class="text-muted">{self.testmsg_4.timestamp.strftime("%d %B %Y")}</span>', html)
@@ -316,6 +371,334 @@ class UserModelTestCase(TestCase):
             self.assertIn(f'<form method="POST" action="/users/add_like/{self.testmsg_3.id}"', html)
             self.assertNotIn(f'<form method="POST" action="/users/add_like/{self.testmsg_4.id}"', html)
 
+    def test_follow_user_timeline(self):
+        """Does following/unfollowing add/remove that user's messages from the home timeline?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post(url_for('add_follow', follow_id=self.testuser_3.id))
+            resp = c.post(url_for('add_follow', follow_id=self.testuser_3.id))
+            self.assertEqual(resp.status_code, 302)
+            entries = TimelineEntry.query.filter_by(
+                user_id=self.testuser.id, author_id=self.testuser_3.id)
+            self.assertEqual({entry.message_id for entry in entries},
+                             {self.testmsg_5.id, self.testmsg_6.id})
+
+            resp = c.get(url_for('homepage'))
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'<p>{self.testmsg_5.text}</p>', html)
+            self.assertIn(f'<p>{self.testmsg_6.text}</p>', html)
+
+            c.post(url_for('stop_following', follow_id=self.testuser_3.id))
+            self.assertEqual(TimelineEntry.query.filter_by(
+                user_id=self.testuser.id, author_id=self.testuser_3.id).count(), 0)
+
+            resp = c.post(url_for('stop_following', follow_id=self.testuser_3.id))
+            self.assertEqual(resp.status_code, 302)
+            resp = c.post(url_for('add_follow', follow_id=0))
+            self.assertEqual(resp.status_code, 404)
+
+            self.testuser_3.deactivated = True
+            db.session.commit()
+            resp = c.post(url_for('add_follow', follow_id=self.testuser_3.id))
+            self.assertEqual(resp.status_code, 404)
+
+    def test_self_follow(self):
+        """Is following yourself refused, and does posting survive a stray self-follow row?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post(url_for('add_follow', follow_id=self.testuser.id), follow_redirects=True)
+            self.assertIn("You can&#39;t follow yourself.", resp.get_data(as_text=True))
+            self.assertEqual(Follows.query.filter_by(
+                user_following_id=self.testuser.id,
+                user_being_followed_id=self.testuser.id).count(), 0)
+
+            # e.g. left behind from before follows were checked
+            db.session.add(Follows(user_being_followed_id=self.testuser.id,
+                                   user_following_id=self.testuser.id))
+            db.session.commit()
+
+            resp = c.post(url_for('messages_add'), data={'text': "Still me"})
+            self.assertEqual(resp.status_code, 302)
+            msg = Message.query.filter_by(text="Still me").one()
+            self.assertEqual(TimelineEntry.query.filter_by(message_id=msg.id).count(), 1)
+
+    def test_homepage_statement_count(self):
+        """Does the home page load authors and like counts without a query per message?"""
+
+        db.session.add(Follows(user_being_followed_id=self.testuser_3.id,
+                               user_following_id=self.testuser.id))
+        db.session.add(Follows(user_being_followed_id=self.testuser_4.id,
+                               user_following_id=self.testuser.id))
+        for i in range(20):
+            db.session.add(Message(text=f"Extra {i}", user_id=self.testuser_4.id))
+        db.session.commit()
+        rebuild_timelines()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get(url_for('homepage'))
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'<p>{self.testmsg_3.text}</p>', html)
+            self.assertIn(f'<p>{self.testmsg_5.text}</p>', html)
+            self.assertIn('<p>Extra 19</p>', html)
+
+    def test_show_user_paginated(self):
+        """Can older messages be reached with the before= cursor?"""
+
+        app.config['MESSAGES_PER_PAGE'] = 1
+
+        try:
+            with self.client as c:
+                resp = c.get(url_for('users_show', user_id=self.testuser.id))
+                html = resp.get_data(as_text=True)
+                cursor = encode_cursor(self.testmsg_2)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn(f'<p>{self.testmsg_2.text}</p>', html)
+                self.assertNotIn(f'<p>{self.testmsg.text}</p>', html)
+                self.assertIn(f'href="/users/{self.testuser.id}?before={cursor}"', html)
+
+                resp = c.get(url_for('users_show', user_id=self.testuser.id, before=cursor))
+                html = resp.get_data(as_text=True)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn(f'<p>{self.testmsg.text}</p>', html)
+                self.assertNotIn(f'<p>{self.testmsg_2.text}</p>', html)
+                self.assertNotIn('id="older-messages"', html)
+
+                resp = c.get(url_for('users_show', user_id=self.testuser.id, before="not-a-cursor"))
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+    def test_show_user_conditional_get(self):
+        """Is an unchanged profile answered with 304, and a changed one re-sent?"""
+
+        with self.client as c:
+            resp = c.get(url_for('users_show', user_id=self.testuser.id))
+            etag = resp.headers['ETag']
+
+            self.assertIn('public', resp.headers['Cache-Control'])
+            self.assertIn('no-cache', resp.headers['Cache-Control'])
+            self.assertIn('Last-Modified', resp.headers)
+
+            resp = c.get(url_for('users_show', user_id=self.testuser.id),
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+
+            db.session.add(Message(text="Brand new", user_id=self.testuser.id))
+            db.session.commit()
+
+            resp = c.get(url_for('users_show', user_id=self.testuser.id),
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<p>Brand new</p>', resp.get_data(as_text=True))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_2.id
+
+            resp = c.get(url_for('users_show', user_id=self.testuser.id),
+                         headers={'If-None-Match': resp.headers['ETag']})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('private', resp.headers['Cache-Control'])
+
+            resp = c.get(url_for('homepage'))
+            self.assertIn('no-store', resp.headers['Cache-Control'])
+
+    def test_compressed_response(self):
+        """Are pages gzipped for clients that accept it, and only for them?"""
+
+        with self.client as c:
+            resp = c.get(url_for('list_users'), headers={'Accept-Encoding': 'gzip'})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', resp.headers['Vary'])
+            html = gzip.decompress(resp.get_data()).decode()
+            self.assertIn(f'<p>@{self.testuser.username}</p>', html)
+
+            resp = c.get(url_for('list_users'))
+            self.assertNotIn('Content-Encoding', resp.headers)
+            self.assertIn('Accept-Encoding', resp.headers['Vary'])
+
+    def test_precompress_static_rerun(self):
+        """Does precompressing again leave the earlier copies alone?"""
+
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, 'style.css'), 'w') as f:
+                f.write('body { color: black; }' * 50)
+
+            first = sorted(precompress_static(folder))
+            second = sorted(precompress_static(folder))
+
+            self.assertIn('style.css.gz', first)
+            self.assertEqual(second, first)
+            self.assertEqual(sorted(os.listdir(folder)), sorted(first + ['style.css']))
+
+    def test_static_fingerprints(self):
+        """Are static assets linked by content hash and cached as immutable?"""
+
+        with self.client as c:
+            html = c.get(url_for('homepage')).get_data(as_text=True)
+            version = app.extensions['static_manifest']['stylesheets/style.css']
+            url = f'/static/stylesheets/style.css?v={version}'
+
+            self.assertIn(f'href="{url}"', html)
+
+            resp = c.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+            self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+            resp.close()
+
+            resp = c.get('/static/stylesheets/style.css')
+            self.assertIn('no-cache', resp.headers['Cache-Control'])
+            resp.close()
+
+            # Stored default images are fingerprinted too; external ones aren't
+            html = c.get(url_for('users_show', user_id=self.testuser_2.id)).get_data(as_text=True)
+            hero = app.extensions['static_manifest']['images/warbler-hero.jpg']
+            self.assertIn(f'/static/images/warbler-hero.jpg?v={hero}', html)
+            self.assertIn(f'src="{TEST_IMAGE}"', html)
+
+            # A stale or made-up fingerprint mustn't pin the file for a year
+            resp = c.get('/static/stylesheets/style.css?v=0123456789ab')
+            self.assertNotIn('immutable', resp.headers['Cache-Control'])
+            self.assertIn('no-cache', resp.headers['Cache-Control'])
+            resp.close()
+
+    def test_profile_edit_refreshes_identity(self):
+        """Does editing a profile refresh the cached identity shown in the nav bar?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get(url_for('homepage')).get_data(as_text=True)
+            self.assertIn(f'<p>@{self.testuser.username}</p>', html)
+
+            resp = c.post(url_for('profile'), data={
+                "username": "renameduser",
+                "email": self.testuser.email,
+                "image_url": self.testuser.image_url,
+                "header_image_url": self.testuser.header_image_url,
+                "bio": "",
+                "location": "",
+                "password": "testuser",
+            })
+            self.assertEqual(resp.status_code, 302)
+
+            html = c.get(url_for('homepage')).get_data(as_text=True)
+            self.assertIn('<p>@renameduser</p>', html)
+
+    def test_delete_user_in_background(self):
+        """Is a deleted account hidden at once, then purged in batches with counters kept right?"""
+
+        db.session.add(Follows(user_being_followed_id=self.testuser.id,
+                               user_following_id=self.testuser_3.id))
+        db.session.commit()
+        app.config['USER_DELETION_BATCH_SIZE'] = 1
+        app.config['ADMIN_USERNAMES'] = {self.testuser_2.username}
+        user_id = self.testuser.id
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+
+                # Cache testuser_2's stats while testuser still follows them
+                followers_link = f'<a href="/users/{self.testuser_2.id}/followers">'
+                html = c.get(url_for('users_show', user_id=self.testuser_2.id)).get_data(as_text=True)
+                self.assertIn(f'{followers_link}1</a>', html)
+
+                resp = c.post(url_for('delete_user'))
+                self.assertEqual(resp.status_code, 302)
+                self.assertEqual(c.get(url_for('users_show', user_id=user_id)).status_code, 404)
+
+                app.extensions['user_deletion'].wait()
+                db.session.expire_all()
+
+                self.assertIsNone(User.query.get(user_id))
+                self.assertEqual(Message.query.filter_by(user_id=user_id).count(), 0)
+                self.assertEqual(Likes.query.filter_by(user_id=user_id).count(), 0)
+                self.assertEqual(User.query.get(self.testuser_2.id).follower_count, 0)
+                self.assertEqual(User.query.get(self.testuser_2.id).like_count, 0)
+                self.assertEqual(User.query.get(self.testuser_3.id).following_count, 1)
+                self.assertEqual(Message.query.get(self.testmsg_4.id).like_count, 0)
+
+                html = c.get(url_for('users_show', user_id=self.testuser_2.id)).get_data(as_text=True)
+                self.assertIn(f'{followers_link}0</a>', html)
+
+                self.assertEqual(c.get('/admin/deletions').status_code, 404)
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_2.id
+                status = c.get('/admin/deletions').get_json()[str(user_id)]
+                self.assertEqual(status['state'], 'done')
+                self.assertEqual(status['deleted'], {'messages': 2, 'likes': 2, 'following': 1, 'followers': 1})
+        finally:
+            app.config['USER_DELETION_BATCH_SIZE'] = 1000
+            app.config['ADMIN_USERNAMES'] = set()
+
+    def test_request_instrumentation(self):
+        """Are latency, SQL and template timings recorded per endpoint and shown to admins?"""
+
+        engine = db.get_engine(app)
+        timed = Flask(__name__)
+        timed.config['INSTRUMENTATION_ENABLED'] = True
+        install_instrumentation(timed)
+
+        @timed.route('/timed')
+        def timed_view():
+            engine.execute('SELECT 1')
+            engine.execute('SELECT 2')
+            return render_template_string('{{ n }}', n=1)
+
+        # A failing statement mustn't leave timing state on its connection
+        with engine.connect() as conn:
+            info = dict(conn.info)
+            with self.assertRaises(Exception):
+                conn.execute('SELECT * FROM no_such_table')
+            self.assertEqual(conn.info, info)
+
+        try:
+            for _ in range(3):
+                resp = timed.test_client().get('/timed')
+                self.assertIn('desc="2 statements"', resp.headers['Server-Timing'])
+
+            with self.client as c:
+                self.assertEqual(c.get('/admin/metrics').status_code, 404)
+
+                app.config['ADMIN_USERNAMES'] = {self.testuser.username}
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                timings = c.get('/admin/metrics').get_json()['endpoints']['timed_view']
+                self.assertEqual(timings['latency']['count'], 3)
+                self.assertEqual(timings['sql_count']['p99'], 2)
+                self.assertGreater(timings['template_time']['max'], 0)
+
+                text = c.get('/admin/metrics/prometheus').get_data(as_text=True)
+                self.assertIn('warbler_request_seconds{endpoint="timed_view",quantile="0.95"}', text)
+                self.assertIn('warbler_request_sql_statements_count{endpoint="timed_view"} 3', text)
+        finally:
+            app.config['ADMIN_USERNAMES'] = set()
+            for stats in request_stats.values():
+                stats.clear()
+
     def test_show_user_followers_non_user(self):
         """Does a user's followers not show up for non-users"""
 
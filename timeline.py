@@ -0,0 +1,230 @@
+"""Materialized home timelines for Warbler.
+
+Each user's home timeline is stored in the `timelines` table. Posting a
+message pushes one row to the author and to each of their followers;
+following or unfollowing someone adds or removes that author's rows.
+
+Authors with at least CELEBRITY_FOLLOWER_THRESHOLD followers are not
+fanned out; their messages are pulled and merged in when a timeline is
+read, so a single post never turns into tens of thousands of writes. When
+one drops back below the threshold, `restore_authors()` pushes whatever
+their followers missed in the meantime.
+"""
+
+from heapq import merge
+
+from flask import current_app
+from sqlalchemy import and_, exists, literal, select
+from sqlalchemy.orm import joinedload
+
+from models import db, Follows, Message, TimelineEntry, User
+from pagination import newest_first, page_size, split_page
+
+TIMELINE_COLUMNS = ['user_id', 'timestamp', 'message_id', 'author_id']
+
+
+def celebrity_threshold():
+    """Follower count at which an author's messages are pulled, not pushed."""
+
+    return current_app.config['CELEBRITY_FOLLOWER_THRESHOLD']
+
+
+def is_celebrity(user_id):
+    """Does this user have too many followers to fan out to?"""
+
+    followers = (db.session
+                 .query(User.follower_count)
+                 .filter(User.id == user_id)
+                 .scalar())
+    return (followers or 0) >= celebrity_threshold()
+
+
+def celebrity_author_ids():
+    """Subquery of every author at or above the celebrity threshold."""
+
+    return (select([User.id])
+            .where(User.follower_count >= celebrity_threshold()))
+
+
+def followed_celebrity_ids(user_id):
+    """IDs of the celebrities `user_id` follows."""
+
+    rows = (db.session
+            .query(Follows.user_being_followed_id)
+            .join(User, User.id == Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id,
+                    User.follower_count >= celebrity_threshold())
+            .all())
+    return [followed_id for (followed_id,) in rows]
+
+
+def fan_out_message(message):
+    """Push a newly posted (and flushed) message into its author's
+    timeline and, unless the author is a celebrity, the timeline of
+    everyone following the author."""
+
+    timelines = TimelineEntry.__table__
+
+    if not is_celebrity(message.user_id):
+        followers = select([
+            Follows.user_following_id,
+            literal(message.timestamp, db.DateTime),
+            literal(message.id),
+            literal(message.user_id),
+        ]).where((Follows.user_being_followed_id == message.user_id)
+                 & (Follows.user_following_id != message.user_id))
+
+        db.session.execute(
+            timelines.insert().from_select(TIMELINE_COLUMNS, followers))
+
+    db.session.execute(timelines.insert().values(
+        user_id=message.user_id,
+        timestamp=message.timestamp,
+        message_id=message.id,
+        author_id=message.user_id,
+    ))
+
+
+def remove_message(message_id):
+    """Remove a message from every timeline it was pushed to."""
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.message_id == message_id)
+     .delete(synchronize_session=False))
+
+
+def add_author(user_id, author_id):
+    """Backfill `user_id`'s timeline with everything `author_id` posted.
+
+    Celebrities are skipped, since their messages are pulled on read, as
+    is the user themselves, whose own messages are always there.
+    """
+
+    if user_id == author_id or is_celebrity(author_id):
+        return
+
+    messages = select([
+        literal(user_id),
+        Message.timestamp,
+        Message.id,
+        Message.user_id,
+    ]).where(Message.user_id == author_id)
+
+    db.session.execute(TimelineEntry.__table__.insert().from_select(
+        TIMELINE_COLUMNS, messages))
+
+
+def restore_authors(author_ids):
+    """Backfill the followers of any of `author_ids` that just dropped below
+    the celebrity threshold (by losing one follower) with the messages that
+    weren't pushed to them while it was pulled instead. Caller commits."""
+
+    dropped = [author_id for (author_id,) in
+               db.session.query(User.id).filter(
+                   User.id.in_(author_ids),
+                   User.follower_count == celebrity_threshold() - 1)]
+
+    for author_id in dropped:
+        missing = select([
+            Follows.user_following_id,
+            Message.timestamp,
+            Message.id,
+            Message.user_id,
+        ]).where(
+            (Follows.user_being_followed_id == author_id)
+            & (Follows.user_following_id != author_id)
+            & (Message.user_id == author_id)
+            & ~exists().where(and_(
+                TimelineEntry.user_id == Follows.user_following_id,
+                TimelineEntry.message_id == Message.id)))
+
+        db.session.execute(TimelineEntry.__table__.insert().from_select(
+            TIMELINE_COLUMNS, missing))
+
+
+def remove_author(user_id, author_id):
+    """Drop every message by `author_id` from `user_id`'s timeline."""
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id == user_id,
+             TimelineEntry.author_id == author_id)
+     .delete(synchronize_session=False))
+
+
+def rebuild_timelines():
+    """Throw away and regenerate every materialized timeline.
+
+    Used to backfill after seeding or to repair drift. Caller commits.
+    """
+
+    timelines = TimelineEntry.__table__
+
+    TimelineEntry.query.delete(synchronize_session=False)
+
+    own_messages = select([
+        Message.user_id,
+        Message.timestamp,
+        Message.id,
+        Message.user_id.label('author_id'),
+    ])
+    followed_messages = select([
+        Follows.user_following_id,
+        Message.timestamp,
+        Message.id,
+        Message.user_id,
+    ]).where(Follows.user_being_followed_id == Message.user_id).where(
+        Follows.user_following_id != Message.user_id).where(
+        Message.user_id.notin_(celebrity_author_ids()))
+
+    db.session.execute(
+        timelines.insert().from_select(TIMELINE_COLUMNS, own_messages))
+    db.session.execute(
+        timelines.insert().from_select(TIMELINE_COLUMNS, followed_messages))
+
+
+def home_timeline(user_id, before=None, limit=None):
+    """Return one page of `user_id`'s home timeline, older than the
+    `before` cursor, along with the cursor for the next page.
+
+    The materialized (pushed) timeline and the recent messages of the
+    followed celebrities are each already newest-first, so they are
+    combined with a merge on (timestamp, id).
+    """
+
+    limit = limit or page_size()
+
+    pushed = newest_first(
+        (Message
+         .query
+         .options(joinedload(Message.user))
+         .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+         .filter(TimelineEntry.user_id == user_id)),
+        TimelineEntry.timestamp, TimelineEntry.message_id, before, limit + 1)
+
+    celebrity_ids = followed_celebrity_ids(user_id)
+    if not celebrity_ids:
+        return split_page(pushed, limit)
+
+    pulled = newest_first(
+        (Message
+         .query
+         .options(joinedload(Message.user))
+         .filter(Message.user_id.in_(celebrity_ids))),
+        Message.timestamp, Message.id, before, limit + 1)
+
+    # A celebrity's older messages may also have been pushed before they
+    # crossed the threshold, so skip anything already seen.
+    messages = []
+    seen = set()
+    for msg in merge(pushed, pulled,
+                     key=lambda msg: (msg.timestamp, msg.id), reverse=True):
+        if msg.id in seen:
+            continue
+        seen.add(msg.id)
+        messages.append(msg)
+        if len(messages) > limit:
+            break
+
+    return split_page(messages, limit)